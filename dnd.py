@@ -1,55 +1,108 @@
 from contextlib import suppress, asynccontextmanager
+from functools import lru_cache
+from collections import OrderedDict
 from typing import Optional, Literal, Annotated, Any
-from pydantic import BaseModel, Field, ConfigDict
-import operator
+from pydantic import BaseModel, Field, ConfigDict, ValidationError, BeforeValidator, WithJsonSchema, field_serializer, SerializationInfo
 
 from langgraph.graph import StateGraph, START, END
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph.message import add_messages, REMOVE_ALL_MESSAGES
+from langgraph.types import Command
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.prebuilt import ToolNode, tools_condition
 
 from langchain_core.tools import tool, ToolException
+from langchain_core.exceptions import OutputParserException
+from langchain_core.callbacks import adispatch_custom_event
+from langchain_core.runnables import RunnableConfig
 from langchain_mcp_adapters.tools import load_mcp_tools
 from langchain.agents import create_agent
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, BaseMessage, ToolMessage
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, BaseMessage, ToolMessage, RemoveMessage
 
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_community.tools import DuckDuckGoSearchResults
 from langchain_community.retrievers import WikipediaRetriever
 
 import asyncio
+import atexit
+import json
+import os
 import traceback
 import sys
 import base64
+import io
 import random
+import re
+import uuid
 import logging
     
 from mcp.client.sse import sse_client
 from mcp.client.session import ClientSession
 
 from google import genai
-from google.genai import types
+from google.genai import types, errors as genai_errors
 from PIL import Image
 
-import json
+MCP_SERVER_URL = "http://localhost:8000/sse"
+
+class MCPConnectionPool:
+    """Keeps one MCP SSE session open so every node call reuses its handshake and loaded tools.
+    The SSE client's task group must be entered and exited in the same task, so the session lives
+    in a background task that stays parked until close() (or until the connection drops)."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._tools: list = []
+        self._task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Event] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def _run(self):
+        try:
+            async with sse_client(self.url) as session_streams:
+                async with ClientSession(session_streams[0], session_streams[1]) as session:
+                    await session.initialize()
+                    self._tools = await load_mcp_tools(session)
+                    self._ready.set()
+                    await self._stop.wait()
+        except ExceptionGroup:
+            pass # Ignore TaskGroup teardown errors from SSE client
+        except Exception as e:
+            print(f"MCP Connection Error: {e}", file=sys.stderr)
+        finally:
+            # A dead session hands out no tools; the next get_tools() call reconnects
+            self._tools = []
+            self._ready.set()
+
+    async def get_tools(self) -> list:
+        """Returns the pooled MCP tools, (re)connecting if there is no live session on this loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Sessions and asyncio primitives are tied to the loop that created them
+            self._loop, self._lock, self._task = loop, asyncio.Lock(), None
+
+        async with self._lock:
+            if self._task is None or self._task.done():
+                self._tools = []
+                self._ready, self._stop = asyncio.Event(), asyncio.Event()
+                self._task = asyncio.create_task(self._run())
+            await self._ready.wait()
+            return self._tools
+
+    async def close(self):
+        """Closes the pooled session, if one is open."""
+        if self._task is not None and not self._task.done():
+            self._stop.set()
+            await self._task
+        self._task = None
+
+mcp_pool = MCPConnectionPool(MCP_SERVER_URL)
 
 @asynccontextmanager
 async def mcp_server_session():
-    """Reusable context manager for MCP tool connections."""
-    mcp_tools = []
-    try:
-        async with sse_client("http://localhost:8000/sse") as session_streams:
-            async with ClientSession(session_streams[0], session_streams[1]) as session:
-                await session.initialize()
-                mcp_tools = await load_mcp_tools(session)
-                yield mcp_tools
-    except ExceptionGroup:
-        pass # Ignore TaskGroup teardown errors from SSE client
-    except Exception as e:
-        print(f"MCP Connection Error: {e}", file=sys.stderr)
-    finally:
-        # Fallback yield just in case the exception was caught before the primary yield
-        if not mcp_tools:
-            yield mcp_tools
+    """Reusable context manager for MCP tool connections, backed by the shared mcp_pool session."""
+    yield await mcp_pool.get_tools()
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -69,6 +122,64 @@ writer_model = ChatGoogleGenerativeAI(
 
 imagen_client = genai.Client()
 
+# Placeholder swapped in for base64 images when state is serialized into an LLM prompt
+IMAGE_PLACEHOLDER = "[GENERATED IMAGE STORED]"
+
+# Max image generation requests in flight at once per worker process (stays under the image API rate limit;
+# with several API workers the effective cap is workers x this value)
+IMAGE_MAX_CONCURRENCY = int(os.getenv("IMAGE_MAX_CONCURRENCY", "4"))
+IMAGE_SLOTS = asyncio.Semaphore(IMAGE_MAX_CONCURRENCY)
+
+# Set SPECULATIVE_GROUP_IMAGE=1 to run the group shot's text-only fallback concurrently with the multimodal attempt
+SPECULATIVE_GROUP_IMAGE = os.getenv("SPECULATIVE_GROUP_IMAGE") == "1"
+
+# Rate-limited (429) image calls are retried with exponential backoff starting at this many seconds
+IMAGE_RATE_LIMIT_RETRIES = 3
+IMAGE_RATE_LIMIT_BACKOFF = 4
+
+# Generated images are stored as JPEG (what the frontend data URLs declare), capped at this size
+STORED_IMAGE_MAX_SIDE = 1920
+STORED_IMAGE_JPEG_QUALITY = 85
+
+# Leading bytes of the formats we store; any 4n-length alphabetic string is valid base64, so decoding alone proves nothing
+IMAGE_MAGIC_BYTES = (b"\xff\xd8\xff", b"\x89PNG")
+
+def _decode_stored_image(value: Any) -> Any:
+    """Images arrive over JSON as base64 text; decode that to raw bytes.
+    Anything that doesn't decode to a JPEG/PNG (e.g. a model writing "none" into the field) is dropped.
+    Checkpoints are restored with model_construct, which skips this validator, so code that hands
+    stored images to the image API must go through image_bytes() instead of trusting the field type."""
+    if isinstance(value, str):
+        try:
+            data = base64.b64decode(value, validate=True)
+        except ValueError:
+            return None
+        return data if data.startswith(IMAGE_MAGIC_BYTES) else None
+    return value
+
+def image_bytes(value: Any) -> Optional[bytes]:
+    """Return a stored image as raw bytes, decoding base64 text left behind by checkpoints written before images were bytes."""
+    data = _decode_stored_image(value)
+    return data if isinstance(data, bytes) and data else None
+
+# Image fields hold raw JPEG bytes in state and checkpoints; base64 is only produced when dumping to JSON.
+# The JSON schema stays a plain string so the LLM-facing schemas are unchanged.
+StoredImage = Annotated[
+    Optional[Annotated[bytes, WithJsonSchema({"type": "string"})]],
+    BeforeValidator(_decode_stored_image),
+]
+
+def _scrub_image(value: Optional[bytes], info: SerializationInfo) -> Optional[bytes | str]:
+    """Replace an image with a placeholder when dumping with context={'for_prompt': True},
+    and base64-encode it for JSON output (the SSE/REST payloads the frontend renders)."""
+    if not value:
+        return value
+    if info.context and info.context.get("for_prompt"):
+        return IMAGE_PLACEHOLDER
+    if info.mode_is_json() and isinstance(value, bytes):
+        return base64.b64encode(value).decode('utf-8')
+    return value
+
 # --- Schemas ---
 class RouteDecision(BaseModel):
     """Determines which node to route to based on the user's latest request"""
@@ -87,6 +198,16 @@ class Spell(BaseModel):
     level: int = Field(description="Spell level (0 for cantrips)")
     description: str = Field(description="Brief spell effect, including damage/healing or save DC if applicable.")
 
+class AbilityScores(BaseModel):
+    """The six standard D&D ability scores. Missing scores default to 10 so older saved parties still load."""
+    model_config = ConfigDict(frozen=True)
+    STR: int = Field(default=10, description="Strength score")
+    DEX: int = Field(default=10, description="Dexterity score")
+    CON: int = Field(default=10, description="Constitution score")
+    INT: int = Field(default=10, description="Intelligence score")
+    WIS: int = Field(default=10, description="Wisdom score")
+    CHA: int = Field(default=10, description="Charisma score")
+
 class VillainStatblock(BaseModel):
     """Stats and abilities of the primary antagonist. MUST BE HIGHLY CREATIVE AND UNIQUE. Avoid boring generic tropes (like 'evil wizard' or 'bandit king') unless you give them a bizarre, memorable twist!"""
     hp: int = Field(description="Max hit points")
@@ -95,7 +216,11 @@ class VillainStatblock(BaseModel):
     physical_description: str = Field(description="A vivid, weird, and detailed physical description of the villain's appearance. Include height, build, distinctive features, clothing, and any unnatural traits. This needs to look incredibly cool and distinct for image generation.")
     attacks: list[str] = Field(description="List of attacks with to-hit and damage (e.g., '+7 to hit | 2d8+4 slashing'). Give the attacks creative names.")
     special_abilities: list[str] = Field(default_factory=list, description="Unique, terrifying, or bizarre villain abilities and legendary actions")
-    image_base64: Optional[str] = Field(default=None, description="A Base64 string of the villain's generated portrait.")
+    image_base64: StoredImage = Field(default=None, description="A Base64 string of the villain's generated portrait.")
+
+    @field_serializer("image_base64")
+    def _scrub_image_base64(self, value: Optional[bytes], info: SerializationInfo) -> Optional[bytes | str]:
+        return _scrub_image(value, info)
 
 class Character(BaseModel):
     """Character schema with detailed attributes, personality, combat stats, and inventory."""
@@ -121,7 +246,7 @@ class Character(BaseModel):
     ac: int = Field(description="Armor Class based on their gear")
 
     # Image
-    image_base64: Optional[str] = Field(default=None, description="A Base64 string of the character's generated portrait.")
+    image_base64: StoredImage = Field(default=None, description="A Base64 string of the character's generated portrait.")
 
     weapons: list[Weapon] = Field(
         default_factory=list, 
@@ -133,7 +258,7 @@ class Character(BaseModel):
         description="List of known spells. Empty for martial classes."
     )
     
-    ability_scores: dict[str, int] = Field(description="A dictionary of standard D&D stats (STR, DEX, CON, INT, WIS, CHA) generated using standard array or point buy.")
+    ability_scores: AbilityScores = Field(description="The standard D&D stats (STR, DEX, CON, INT, WIS, CHA) generated using standard array or point buy.")
     
     skills: list[str] = Field(
         default_factory=list, 
@@ -145,6 +270,10 @@ class Character(BaseModel):
         description="Key items, adventuring gear, or trinkets (Do not include equipped weapons here)"
     )
 
+    @field_serializer("image_base64")
+    def _scrub_image_base64(self, value: Optional[bytes], info: SerializationInfo) -> Optional[bytes | str]:
+        return _scrub_image(value, info)
+
 class PartyDetails(BaseModel):
     """Details about the party, including its name, size, and characters."""
     party_name: str = Field(description="Name of the party")
@@ -169,9 +298,13 @@ class CampaignPlan(BaseModel):
     key_locations: list[str] = Field(description="Specific areas within the terrain the party will visit")
     suggested_party: list[BaseCharacter] = Field(description="A list of suggested heroes (name, race, class) that fit this specific campaign.")
     loot_concept: str = Field(description="The general idea for the final reward")
-    cover_image_base64: Optional[str] = Field(default=None, description="Campaign cover art")
-    group_image_base64: Optional[str] = Field(default=None, description="Group portrait of all heroes")
-    macguffin_image_base64: Optional[str] = Field(default=None, description="Image of the final loot or artifact")
+    cover_image_base64: StoredImage = Field(default=None, description="Campaign cover art")
+    group_image_base64: StoredImage = Field(default=None, description="Group portrait of all heroes")
+    macguffin_image_base64: StoredImage = Field(default=None, description="Image of the final loot or artifact")
+
+    @field_serializer("cover_image_base64", "group_image_base64", "macguffin_image_base64")
+    def _scrub_image_base64(self, value: Optional[bytes], info: SerializationInfo) -> Optional[bytes | str]:
+        return _scrub_image(value, info)
 
 class DynamicHitlActions(BaseModel):
     """Dynamically generated branch options for the DM to choose from."""
@@ -193,7 +326,7 @@ class CampaignState(BaseModel):
     """The unified state passed through the LangGraph."""
 
     # Message History
-    messages: Annotated[list[BaseMessage], operator.add] = Field(default_factory=list)
+    messages: Annotated[list[BaseMessage], add_messages] = Field(default_factory=list)
 
     # Inputs
     terrain: Optional[Literal["Arctic", "Coast", "Desert", "Forest", "Grassland", "Mountain", "Swamp", "Underdark"]] = None
@@ -213,45 +346,108 @@ class CampaignState(BaseModel):
     # Chat (post-generation conversation)
     chat_messages: list[dict] = Field(default_factory=list, description="Chat history: [{role: 'user'|'assistant', content: str}]")
     chat_response: Optional[str] = Field(default=None, description="Latest chat response from the DM")
+    chat_context: Optional[str] = Field(default=None, description="Campaign summary cached by ChatNode; cleared whenever the plan, party or prose change")
 
 # --- Tools ---
+# Search clients are built once; each construction sets up its API wrapper.
+# Planner queries come from a small spark/terrain/difficulty space, so repeats (retries, plan edits) are common.
+# Failed lookups raise and are therefore never cached.
+ddg_search = DuckDuckGoSearchResults()
+wikipedia_retriever = WikipediaRetriever(top_k_results=2, doc_content_chars_max=1000)
+
+@lru_cache(maxsize=256)
+def cached_internet_search(query: str) -> str:
+    return ddg_search.invoke(query)
+
+@lru_cache(maxsize=256)
+def cached_wikipedia_search(query: str) -> str:
+    docs = wikipedia_retriever.invoke(query)
+    if not docs:
+        return "No Wikipedia results found."
+    return "\n\n".join([f"Title: {doc.metadata.get('title', 'Unknown')}\nSummary: {doc.page_content.strip()}" for doc in docs])
+
 @tool
 def search_internet(query: str) -> str:
     """Search the internet for D&D campaign inspiration."""
-    search_tool = DuckDuckGoSearchResults()
-    return search_tool.invoke(query)
+    return cached_internet_search(query)
 
 @tool
 def search_wikipedia(query: str) -> str:
     """Pull brief references from Wikipedia for fantasy inspiration."""
-    retriever = WikipediaRetriever(top_k_results=2, doc_content_chars_max=1000)
-    docs = retriever.invoke(query)
-    if not docs:
-        return "No Wikipedia results found."
-    return "\n\n".join([f"Title: {doc.metadata.get('title', 'Unknown')}\nSummary: {doc.page_content.strip()}" for doc in docs])
+    return cached_wikipedia_search(query)
+
+# Filler for empty party slots, validated once; build_fallback_character only copies it
+FALLBACK_CHARACTER = Character(
+    name="TBD Adventurer",
+    race="Human",
+    class_name="Fighter",
+    level=1,
+    alignment="Neutral",
+    flavor_quote="Ready for whatever the road brings.",
+    physical_description="An eager adventurer of average height and sturdy build, outfitted with practical travel gear.",
+    hp=10,
+    ac=10,
+    ability_scores=AbilityScores(),
+    weapons=[],
+    spells=[],
+    skills=[],
+    inventory=[],
+    personality_traits=["Cautious", "Reliable"],
+)
+
+def build_fallback_character(index: int) -> Character:
+    """Returns a fresh copy of FALLBACK_CHARACTER named for its slot in the party."""
+    return FALLBACK_CHARACTER.model_copy(update={"name": f"TBD Adventurer {index}"}, deep=True)
+
+# Structured-output runnables are built once; with_structured_output rebuilds the schema + parser chain on every call
+plan_model = research_model.with_structured_output(CampaignPlan)
+party_model = research_model.with_structured_output(PartyDetails)
+# The writer gets a JSON schema rather than the Pydantic class, which makes the parser yield partial dicts while streaming
+narrative_model = writer_model.with_structured_output(CampaignContent.model_json_schema())
+
+# research_model bound to a given MCP tool set, keyed by tool names + descriptions
+_BOUND_MODEL_CACHE: dict[tuple, Any] = {}
+
+def get_model_with_tools(mcp_tools: list) -> Any:
+    """Returns research_model bound to the MCP tools, reusing the binding across requests.
+    PartyDetails is always bound as well, so the model can return the finished party as a tool call."""
+    key = tuple((t.name, t.description) for t in mcp_tools)
+    bound = _BOUND_MODEL_CACHE.get(key)
+    if bound is None:
+        bound = research_model.bind_tools([*mcp_tools, PartyDetails])
+        _BOUND_MODEL_CACHE[key] = bound
+    return bound
+
+# Story seeds sampled by the planner to get unique campaigns
+SPARKS = (
+    "ancient ruins", "political intrigue", "planar invasion", "an undead curse", 
+    "a feywild connection", "a dragon cult", "abyssal corruption", "a lost magical artifact", 
+    "a celestial prophecy", "a dark guild", "a forgotten clockwork city", "a heist on a moving train",
+    "a cursed sentient weapon that manipulates its wielder", "a murder mystery at a masquerade ball",
+    "a gladiator tournament run by devils", "an illusionary village that only exists at night",
+    "a massive floating island slowly crashing to the ground", "a patron deity suddenly going silent",
+    "a time loop trapping the party in a deadly dungeon", "a war between two ancient dragon siblings",
+    "a mind flayer colony infiltrating the nobility", "an archfey's twisted tea party",
+    "a haunted pirate galleon emerging from the mist", "a black market auction of stolen memories",
+    "a kraken awakening from a centuries-long slumber", "a cult trying to summon an Eldritch horror",
+    "an invasion of vampiric plants consuming a forest", "a city under siege by an army of stone golems",
+    "a rogue magical experiment causing tears in reality", "a labyrinth built by a mad god to test mortals",
+    "a parasitic plague spreading through the local water supply", "a masquerade where the masks give people dark powers",
+    "a rebellion led by awakened animals", "a legendary forge requiring the breath of an ancient dragon to light",
+    "a prison break from the most secure dungeon in the realm", "a mimic colony disguised as an entire tavern"
+)
 
 # --- Nodes ---
-def planner_node(state: CampaignState):
+async def search_or_default(search_tool, query: str, default: str) -> str:
+    """Runs a fallback research tool, returning `default` if the lookup fails."""
+    with suppress(ToolException, ValueError, TypeError):
+        return await search_tool.ainvoke({"query": query})
+    return default
+
+async def planner_node(state: CampaignState):
     """Node 1: Establishes the facts and structured outline of the campaign."""
     # randomly select a spark to get unique campaigns
-    sparks = [
-        "ancient ruins", "political intrigue", "planar invasion", "an undead curse", 
-        "a feywild connection", "a dragon cult", "abyssal corruption", "a lost magical artifact", 
-        "a celestial prophecy", "a dark guild", "a forgotten clockwork city", "a heist on a moving train",
-        "a cursed sentient weapon that manipulates its wielder", "a murder mystery at a masquerade ball",
-        "a gladiator tournament run by devils", "an illusionary village that only exists at night",
-        "a massive floating island slowly crashing to the ground", "a patron deity suddenly going silent",
-        "a time loop trapping the party in a deadly dungeon", "a war between two ancient dragon siblings",
-        "a mind flayer colony infiltrating the nobility", "an archfey's twisted tea party",
-        "a haunted pirate galleon emerging from the mist", "a black market auction of stolen memories",
-        "a kraken awakening from a centuries-long slumber", "a cult trying to summon an Eldritch horror",
-        "an invasion of vampiric plants consuming a forest", "a city under siege by an army of stone golems",
-        "a rogue magical experiment causing tears in reality", "a labyrinth built by a mad god to test mortals",
-        "a parasitic plague spreading through the local water supply", "a masquerade where the masks give people dark powers",
-        "a rebellion led by awakened animals", "a legendary forge requiring the breath of an ancient dragon to light",
-        "a prison break from the most secure dungeon in the realm", "a mimic colony disguised as an entire tavern"
-    ]
-    spark = random.choice(sparks)
+    spark = random.choice(SPARKS)
     search_query = f"D&D quest ideas for a {state.difficulty or 'Medium'} campaign in {state.terrain or 'Forest'} involving {spark}"
     
     # Try Agentic Ideation using Native Google Search
@@ -273,24 +469,23 @@ def planner_node(state: CampaignState):
         
         Show off the unique, internet-grounded ideas you found!
         """
-        ideation_response = writer_model.invoke(ideation_prompt, tools=[{"google_search": {}}])
+        ideation_response = await writer_model.ainvoke(ideation_prompt, tools=[{"google_search": {}}])
         reference_material = f"Agentic Brainstorming & Research:\n{ideation_response.content}"
         logging.info(f"Agentic Brainstorming & Research")
 
     except Exception as e:
         print(f"Native Google Search failed ({e}). Falling back to DuckDuckGo and Wikipedia.")
-        search_results = "No internet search results."
-        wiki_results = "No Wikipedia results."
-        
-        with suppress(ToolException, ValueError, TypeError):
-            search_results = search_internet.invoke({"query": search_query})
-        with suppress(ToolException, ValueError, TypeError):
-            wiki_results = search_wikipedia.invoke({"query": search_query})
-            
+        # DuckDuckGo and Wikipedia are independent lookups, so run them side by side
+        search_results, wiki_results = await asyncio.gather(
+            search_or_default(search_internet, search_query, "No internet search results."),
+            search_or_default(search_wikipedia, search_query, "No Wikipedia results."),
+        )
+
         reference_material = f"Internet Results:\n{search_results}\n\nWikipedia Results:\n{wiki_results}"
 
     # Grab existing plan if it exists
-    existing_plan = state.campaign_plan.model_dump_json(indent=2) if state.campaign_plan else "No plan exists yet."
+    # Compact JSON with image fields scrubbed; indentation and base64 only cost prompt tokens
+    existing_plan = state.campaign_plan.model_dump_json(context={"for_prompt": True}) if state.campaign_plan else "No plan exists yet."
 
     prompt = f"""You are a D&D Campaign Architect. Your job is to create a logical, structured outline for a quest.
     DO NOT write the story yet. Only establish the facts.
@@ -316,16 +511,31 @@ def planner_node(state: CampaignState):
     4. THE COPY-PASTE MANDATE: For every field NOT requested to change, copy the content EXACTLY from the Existing Plan. Do not paraphrase or "improve" it.
     5. COLD START: If no Existing Plan is provided, create a brand new CampaignPlan from scratch.
     """
-    structured_llm = research_model.with_structured_output(CampaignPlan)
-    plan = structured_llm.invoke(prompt)
+    plan = await plan_model.ainvoke(prompt)
     
-    return {"campaign_plan": plan}
+    return {"campaign_plan": plan, "chat_context": None}
+
+async def party_creation_node(state: CampaignState) -> Command[Literal["MCPToolNode", "CharacterPortraitNode", "NarrativeWriterNode", "__end__"]]:
+    """Node 2: Builds the party, potentially calling MCP tools if needed.
+    Routes itself: to tools if the model requested them, otherwise straight to the next pipeline step."""
+    update = await build_party_update(state)
+    if "party_details" in update:
+        update["chat_context"] = None
+
+    messages = update.get("messages")
+    if messages and isinstance(messages[-1], AIMessage) and messages[-1].tool_calls:
+        return Command(update=update, goto="MCPToolNode")
+    return Command(update=update, goto=await determine_next_steps(state, "PartyCreationNode"))
 
-async def party_creation_node(state: CampaignState):
-    """Node 2: Builds the party, potentially calling MCP tools if needed."""
+async def build_party_update(state: CampaignState) -> dict:
+    """Generates the party (or the next tool-call request) and returns the state update."""
     party_name = state.party_details.party_name if state.party_details else "Not Provided"
     party_size = state.party_details.party_size if state.party_details else 4
-    existing_characters = state.party_details.characters if state.party_details else []
+    # Existing sheets go into the prompt as compact JSON with portraits scrubbed (their repr would inline the image bytes)
+    existing_characters = [
+        c.model_dump(mode="json", by_alias=True, context={"for_prompt": True})
+        for c in state.party_details.characters
+    ] if state.party_details else []
 
     # If roster isn't locked, but the planner gave us suggestions, use those as the baseline!
     if not existing_characters and getattr(state.campaign_plan, 'suggested_party', None):
@@ -338,7 +548,7 @@ async def party_creation_node(state: CampaignState):
         if party_name == "Not Provided":
             party_name = "The Suggested Adventurers" # Or generate a name based on the suggested party
 
-    plan_context = state.campaign_plan.model_dump_json(indent=2) if state.campaign_plan else "No plan available."
+    plan_context = state.campaign_plan.model_dump_json(context={"for_prompt": True}) if state.campaign_plan else "No plan available."
 
     mcp_tools = []
     async with mcp_server_session() as tools:
@@ -346,32 +556,13 @@ async def party_creation_node(state: CampaignState):
             mcp_tools = tools
 
     # Bind the MCP tools to our model outside the SSE context!
-    model_with_tools = research_model.bind_tools(mcp_tools) if mcp_tools else research_model
-
-    def build_fallback_character(index: int) -> Character:
-        return Character(
-            name=f"TBD Adventurer {index}",
-            race="Human",
-            class_name="Fighter",
-            level=1,
-            alignment="Neutral",
-            flavor_quote="Ready for whatever the road brings.",
-            physical_description="An eager adventurer of average height and sturdy build, outfitted with practical travel gear.",
-            hp=10,
-            ac=10,
-            ability_scores={"STR": 10, "DEX": 10, "CON": 10, "INT": 10, "WIS": 10, "CHA": 10},
-            weapons=[],
-            spells=[],
-            skills=[],
-            inventory=[],
-            personality_traits=["Cautious", "Reliable"],
-        )
+    model_with_tools = get_model_with_tools(mcp_tools)
 
     system_prompt = f"""You are a master D&D Party Architect and Rules Expert.
     Campaign World Context: {plan_context}
     Party Name: {"Generate an epic, creative name fitting the lore" if party_name == "Not Provided" else party_name}
     Party Size: {party_size}
-    Existing Characters: {existing_characters}
+    Existing Characters: {json.dumps(existing_characters) if existing_characters else "None"}
     Requirements: {state.requirements}
     
     CRITICAL TOOL & CREATIVITY MANDATE:
@@ -379,91 +570,102 @@ async def party_creation_node(state: CampaignState):
     2. GO BEYOND STATS: Tie their backstories, ideals, and bonds directly into the Campaign World Context. Why are they involved in this specific conflict?
     3. Generate a highly creative and unique `flavor_quote` for each character based on their quirks or gear.
     4. Calculate accurate combat stats ('to-hit' and 'damage') for all acquired weapons and spells based on their ability scores.
+    5. Build the WHOLE party at once: batch tool lookups for every character together and return all {party_size} characters in a single PartyDetails response.
     """
 
-    # Format messages
-    if not state.messages:
-        messages = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content="Please research the exact starting stats, gear, and spells for each character based on their class and level.")
-        ]
-    else:
-        messages = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content="Please research the exact starting stats, gear, and spells for each character based on their class and level.")
-        ] + state.messages
+    # Format messages once; every retry attempt below reuses this list
+    messages = [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content="Please research the exact starting stats, gear, and spells for each character based on their class and level.")
+    ]
+    messages.extend(state.messages)
 
     print(f"DEBUG: Checking {len(state.messages) if state.messages else 0} messages.", file=sys.stderr)
     if state.messages:
         print(f"DEBUG: Last message type: {state.messages[-1].type}", file=sys.stderr)
 
-    # Check if we just finished using tools
-    just_finished_tools = False
+    # Skip straight to structured output if we just finished using tools (or a previous attempt was malformed)
+    force_structured = False
     if state.messages and state.messages[-1].type == "tool":
-        just_finished_tools = True
+        force_structured = True
+
+    def finalize_party(final_party: PartyDetails, note: str) -> dict:
+        # Standard cleanup
+        if party_name != "Not Provided":
+            final_party.party_name = party_name
+
+        final_party.party_size = party_size
+        final_party.characters = final_party.characters[:party_size]
+
+        while len(final_party.characters) < party_size:
+            final_party.characters.append(build_fallback_character(len(final_party.characters) + 1))
+
+        return {
+            "messages": [AIMessage(content=note)],
+            "party_details": final_party
+        }
 
     # Generate!
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            if just_finished_tools:
+            if force_structured:
                 # Force Pydantic output!
-                structured_llm = research_model.with_structured_output(PartyDetails)
-                final_party = await structured_llm.ainvoke(messages)
-                
-                # Standard cleanup
-                if party_name != "Not Provided":
-                    final_party.party_name = party_name
-                    
-                final_party.party_size = party_size
-                final_party.characters = final_party.characters[:party_size]
-
-                while len(final_party.characters) < party_size:
-                    final_party.characters.append(build_fallback_character(len(final_party.characters) + 1))
-                
-                return {
-                    "messages": [AIMessage(content="Generated final PartyDetails JSON.")],
-                    "party_details": final_party.model_dump(by_alias=True)
-                }
+                final_party = await party_model.ainvoke(messages)
+                return finalize_party(final_party, "Generated final PartyDetails JSON.")
             else:
-                # Let it decide whether to use tools or write text
+                # Let it decide whether to use tools or write text. PartyDetails is bound as a tool too,
+                # so a model that needs no research can hand back the party in this same call.
                 response = await model_with_tools.ainvoke(messages)
-                
-                if not getattr(response, 'tool_calls', None):
+                tool_calls = getattr(response, 'tool_calls', None) or []
+                party_call = next((tc for tc in tool_calls if tc["name"] == PartyDetails.__name__), None)
+
+                if party_call:
+                    try:
+                        final_party = PartyDetails.model_validate(party_call["args"])
+                        return finalize_party(final_party, "Generated final PartyDetails JSON (no tools).")
+                    except ValidationError as e:
+                        print(f"DEBUG: PartyDetails tool call did not validate ({e}). Forcing structured output...", file=sys.stderr)
+                        tool_calls = []
+
+                if not tool_calls:
                     print("DEBUG: Model declined to use tools. Forcing structured output...", file=sys.stderr)
-                    structured_llm = research_model.with_structured_output(PartyDetails)
-                    final_party = await structured_llm.ainvoke(messages)
-                    
-                    if party_name != "Not Provided":
-                        final_party.party_name = party_name
-                        
-                    final_party.party_size = party_size
-                    final_party.characters = final_party.characters[:party_size]
-
-                    while len(final_party.characters) < party_size:
-                        final_party.characters.append(build_fallback_character(len(final_party.characters) + 1))
-                    
-                    return {
-                        "messages": [AIMessage(content="Generated final PartyDetails JSON (no tools).")],
-                        "party_details": final_party.model_dump(by_alias=True)
-                    }
-                
+                    final_party = await party_model.ainvoke(messages)
+                    return finalize_party(final_party, "Generated final PartyDetails JSON (no tools).")
+
                 # Sanitize response to prevent pickling un-awaited Http/Google SDK coroutines inside response_metadata
                 clean_response = AIMessage(
                     content=str(response.content) if response.content else "",
-                    tool_calls=getattr(response, 'tool_calls', []),
+                    tool_calls=tool_calls,
                     id=response.id
                 )
                 return {"messages": [clean_response]}
+        except (ValidationError, OutputParserException) as e:
+            # A malformed answer is not a transient failure: retry right away, straight to structured output
+            if attempt < max_retries - 1:
+                print(f"Malformed party output on attempt {attempt + 1}: {e}. Retrying with structured output...", file=sys.stderr)
+                force_structured = True
+            else:
+                print(f"Model Invocation Error after {max_retries} attempts: {e}", file=sys.stderr)
+                return {"messages": [AIMessage(content="Tool connection failed, I will generate default characters.")]}
         except Exception as e:
             if attempt < max_retries - 1:
-                print(f"Model Invocation Error on attempt {attempt + 1}: {e}. Retrying in 3 seconds...", file=sys.stderr)
-                await asyncio.sleep(3)
+                # Exponential backoff with jitter so concurrent runs don't retry in lockstep
+                delay = min(30, 2 ** (attempt + 1) + random.random())
+                print(f"Model Invocation Error on attempt {attempt + 1}: {e}. Retrying in {delay:.1f} seconds...", file=sys.stderr)
+                await asyncio.sleep(delay)
             else:
                 print(f"Model Invocation Error after {max_retries} attempts: {e}", file=sys.stderr)
                 return {"messages": [AIMessage(content="Tool connection failed, I will generate default characters.")]}
 
-async def mcp_tool_node(state: CampaignState):
+async def mcp_tool_node(state: CampaignState) -> Command[Literal["PartyCreationNode"]]:
+    """Executes the pending MCP tool calls and hands the results back to PartyCreationNode.
+    ToolNode already runs every tool call of the message concurrently."""
+    # Nothing to execute, so skip the SSE handshake entirely
+    last_message = state.messages[-1] if state.messages else None
+    if not (isinstance(last_message, AIMessage) and last_message.tool_calls):
+        return Command(update={"messages": []}, goto="PartyCreationNode")
+
     result = None
     async with mcp_server_session() as mcp_tools:
         if mcp_tools:
@@ -485,46 +687,73 @@ async def mcp_tool_node(state: CampaignState):
                 ))
             else:
                 sanitized.append(msg)
-        return {"messages": sanitized}
-    return {"messages": []}
+        return Command(update={"messages": sanitized}, goto="PartyCreationNode")
+    return Command(update={"messages": []}, goto="PartyCreationNode")
 
-async def generate_image_base64(prompt: str) -> Optional[str]:
-    """Helper function to call Gemini 2.5 Flash Image and return a base64 string."""
+def compress_image(data: bytes) -> bytes:
+    """Downscale and JPEG-encode generated image bytes before they are stored in state.
+    Checkpoints, SSE payloads and multimodal references all carry these bytes, and raw model output is several MB."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert("RGB")
+            img.thumbnail((STORED_IMAGE_MAX_SIDE, STORED_IMAGE_MAX_SIDE))
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=STORED_IMAGE_JPEG_QUALITY, optimize=True)
+            return buf.getvalue()
+    except Exception as e:
+        print(f"Image compression failed, storing the original image: {e}")
+        return data
+
+async def generate_image_content(contents, config: types.GenerateContentConfig):
+    """Calls the image model inside the shared IMAGE_SLOTS bound.
+    Only rate-limit errors are retried, with an exponential backoff taken outside the semaphore."""
+    for attempt in range(IMAGE_RATE_LIMIT_RETRIES):
+        try:
+            async with IMAGE_SLOTS:
+                return await imagen_client.aio.models.generate_content(
+                    model = 'gemini-2.5-flash-image',
+                    contents = contents,
+                    config = config,
+                )
+        except genai_errors.ClientError as e:
+            if e.code != 429 or attempt == IMAGE_RATE_LIMIT_RETRIES - 1:
+                raise
+            delay = IMAGE_RATE_LIMIT_BACKOFF * 2 ** attempt
+            print(f"Image API rate limited. Retrying in {delay} seconds...")
+            await asyncio.sleep(delay)
+
+async def generate_image_bytes(prompt: str) -> Optional[bytes]:
+    """Helper function to call Gemini 2.5 Flash Image and return the compressed image bytes."""
     try:
         config = types.GenerateContentConfig(
             response_modalities = ['TEXT', 'IMAGE'],
             image_config = types.ImageConfig(
                 aspect_ratio = "16:9",
-                image_size = "4K",
+                # Smallest size whose long side still covers STORED_IMAGE_MAX_SIDE; anything larger is thrown away by compress_image
+                image_size = "2K",
             ),
         )
-        result = await imagen_client.aio.models.generate_content(
-            model = 'gemini-2.5-flash-image',
-            contents = prompt,
-            config = config,
-        )
+        result = await generate_image_content(prompt, config)
         for part in result.parts:
             if part.inline_data is not None:
-                print("✨ Successfully conjured an image. Resting a moment to regain spell slots... (API cooldown)")
-                await asyncio.sleep(4)
-                return base64.b64encode(part.inline_data.data).decode('utf-8')
+                print("✨ Successfully conjured an image.")
+                return await asyncio.to_thread(compress_image, part.inline_data.data)
     except Exception as e:
         print(f"A wild magic surge disrupted the image generation: {e}")
 
-async def generate_image_base64_multimodal(prompt: str, images_b64: list[str]) -> Optional[str]:
-    """Helper function to call Gemini 1.5 Pro (which supports multimodal inference) to redraw/combine images."""
+async def generate_image_bytes_multimodal(prompt: str, images: list[bytes]) -> Optional[bytes]:
+    """Helper function to call Gemini 1.5 Pro (which supports multimodal inference) to redraw/combine images.
+    Reference images are passed (and the result returned) as raw JPEG bytes."""
     try:
         contents = [prompt]
-        for b64 in images_b64:
-            if b64 and b64 != "[GENERATED IMAGE STORED]":
-                img_data = base64.b64decode(b64)
-                contents.append(
-                    types.Part.from_bytes(
-                        data=img_data,
-                        mime_type="image/jpeg"
-                    )
+        for img_data in images:
+            contents.append(
+                types.Part.from_bytes(
+                    data=img_data,
+                    mime_type="image/jpeg"
                 )
-                
+            )
+
         config = types.GenerateContentConfig(
             response_modalities = ['TEXT', 'IMAGE'],
             temperature = 1,
@@ -533,134 +762,179 @@ async def generate_image_base64_multimodal(prompt: str, images_b64: list[str]) -
             ),
         )
 
-        result = await imagen_client.aio.models.generate_content(
-            model='gemini-2.5-flash-image',
-            contents=contents,
-            config=config,
-        )
+        result = await generate_image_content(contents, config)
         
         for part in result.parts:
             if part.inline_data is not None:
-                print("✨ Successfully conjured a magical image. Resting a moment to regain spell slots... (API cooldown)")
-                await asyncio.sleep(4)
-                return base64.b64encode(part.inline_data.data).decode('utf-8')
+                print("✨ Successfully conjured a magical image.")
+                return await asyncio.to_thread(compress_image, part.inline_data.data)
 
     except Exception as e:
         print(f"A wild magic surge disrupted the magical image generation: {e}")
-        await asyncio.sleep(4)
 
     return None
 
-async def character_portrait_node(state: CampaignState):
+# Recently generated cover/macguffin images keyed by (thread_id, exact prompt) so one campaign's art is only
+# ever reused by that same campaign's edits, never handed to another user (LRU, bounded by entry count)
+SCENE_IMAGE_CACHE: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+SCENE_IMAGE_CACHE_SIZE = 32
+
+# --- Image prompt templates ---
+# Only the small per-image fields are formatted in; the long static text is a module constant.
+NO_TEXT_RULE = "Critical Rule: NO TEXT, NO WATERMARKS, NO UI ELEMENTS, NO BORDERS."
+
+VILLAIN_PORTRAIT_PROMPT = """A breathtaking, masterpiece digital painting of a sinister D&D villain, official Dungeons and Dragons 5e sourcebook art style, trending on ArtStation.
+Subject: {description}
+Details: Render them in an intimidating, dramatic pose that exudes power and menace. imposing silhouette.
+Aesthetic: High-fidelity dark fantasy concept art, Unreal Engine 5 render, chilling atmosphere, hyperdetailed villain design, gothic fantasy, eerie glowing accents, cinematic lighting, dramatic shadows, 8k resolution, photorealistic textures, vivid moody colors, painted by Greg Rutkowski and Magali Villeneuve.
+Background: A deeply atmospheric, dark, and cinematic background depicting a corrupted {terrain}.
+""" + NO_TEXT_RULE
+
+HERO_PORTRAIT_PROMPT = """A breathtaking, masterpiece digital painting of a D&D character, official Dungeons and Dragons 5e sourcebook art style.
+Subject: A {race} {class_name}. {description}
+Details: They are wielding {weapons} and carrying {inventory}. Ensure their gear matches their class.
+Aesthetic: High-fidelity fantasy concept art, Unreal Engine 5 render, incredibly detailed, heroic pose, cinematic lighting, 8k resolution, photorealistic textures, painted by Greg Rutkowski and Magali Villeneuve.
+Background: A beautiful, atmospheric background depicting a {terrain}.
+""" + NO_TEXT_RULE
+
+COVER_PROMPT = """A breathtaking, masterpiece digital landscape painting of {location}. Terrain: {terrain}.
+Aesthetic: High-fidelity fantasy concept art, Unreal Engine 5 render, global illumination, ray tracing, incredibly detailed, best quality, cinematic volumetric lighting, 8k resolution, photorealistic textures, vivid colors, painted by Greg Rutkowski and Magali Villeneuve.
+""" + NO_TEXT_RULE
+
+MACGUFFIN_PROMPT = """A breathtaking, masterpiece digital painting of a legendary D&D artifact or treasure: {loot}.
+Aesthetic: High-fidelity fantasy concept art, Unreal Engine 5 render, glowing magical aura, intricate details, best quality, dramatic shadows, cinematic lighting, 8k resolution, photorealistic textures.
+""" + NO_TEXT_RULE
+
+GROUP_PORTRAIT_PROMPT = """A breathtaking, masterpiece digital painting of a diverse adventuring party standing together heroically.
+The party consists of EXACTLY {count} characters:
+{heroes}
+Details: Render all {count} characters standing next to each other, accurately reflecting their different heights, sizes, and builds in a cinematic group shot. They are in a {terrain} environment. DO NOT render them as a grid; composite them into a single, cohesive cinematic shot looking at the camera. Use the provided individual portraits as direct visual reference for their faces, armor, and aesthetic.
+Aesthetic: High-fidelity fantasy concept art, Unreal Engine 5 render, global illumination, ray tracing, incredibly detailed, best quality, cinematic volumetric lighting, 8k resolution, photorealistic textures, vivid colors.
+Critical Rule: NO TEXT, NO WATERMARKS, NO BORDERS. YOU MUST INCLUDE EXACTLY {count} DISTINCT PEOPLE."""
+
+async def character_portrait_node(state: CampaignState, config: RunnableConfig | None = None):
     """Node 4: Generates portraits for each character using Google Imagen."""
+    thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
     if not state.party_details or not state.party_details.characters:
         return {}
 
-    # Generate villain portrait first if present
+    terrain = state.terrain if state.terrain else 'fantasy world'
+
+    # Every image is an (object, field, prompt) job. Villain + hero portraits, the cover, and the
+    # macguffin are independent, so they are all generated concurrently; only the group shot waits
+    # for the hero portraits it uses as reference.
+    portrait_jobs = []
+    scene_jobs = []
+
     if state.campaign_plan and state.campaign_plan.villain_statblock:
         villain = state.campaign_plan.villain_statblock
-        villain_prompt = f"""A breathtaking, masterpiece digital painting of a sinister D&D villain, official Dungeons and Dragons 5e sourcebook art style, trending on ArtStation. 
-        Subject: {villain.physical_description}
-        Details: Render them in an intimidating, dramatic pose that exudes power and menace. imposing silhouette.
-        Aesthetic: High-fidelity dark fantasy concept art, Unreal Engine 5 render, chilling atmosphere, hyperdetailed villain design, gothic fantasy, eerie glowing accents, cinematic lighting, dramatic shadows, 8k resolution, photorealistic textures, vivid moody colors, painted by Greg Rutkowski and Magali Villeneuve. 
-        Background: A deeply atmospheric, dark, and cinematic background depicting a corrupted {state.terrain if state.terrain else 'fantasy world'}.
-        Critical Rule: NO TEXT, NO WATERMARKS, NO UI ELEMENTS, NO BORDERS.
-        """
-        b64 = await generate_image_base64(villain_prompt)
-        if b64:
-            villain.image_base64 = b64
+        villain_prompt = VILLAIN_PORTRAIT_PROMPT.format(description=villain.physical_description, terrain=terrain)
+        portrait_jobs.append((villain, "image_base64", villain_prompt))
 
-    # We generate individual portraits
+    # We generate individual portraits; only the per-character fields are formatted into the template
     for char in state.party_details.characters:
-        weapons_str = ", ".join(w.name for w in char.weapons) if char.weapons else "none"
-        inventory_str = ", ".join(char.inventory) if char.inventory else "none"
-
-        full_prompt = f"""A breathtaking, masterpiece digital painting of a D&D character, official Dungeons and Dragons 5e sourcebook art style. 
-        Subject: A {char.race} {char.class_name}. {char.physical_description if char.physical_description else 'A brave adventurer.'}
-        Details: They are wielding {weapons_str} and carrying {inventory_str}. Ensure their gear matches their class.
-        Aesthetic: High-fidelity fantasy concept art, Unreal Engine 5 render, incredibly detailed, heroic pose, cinematic lighting, 8k resolution, photorealistic textures, painted by Greg Rutkowski and Magali Villeneuve. 
-        Background: A beautiful, atmospheric background depicting a {state.terrain if state.terrain else 'fantasy world'}.
-        Critical Rule: NO TEXT, NO WATERMARKS, NO UI ELEMENTS, NO BORDERS."""
-        
-        b64 = await generate_image_base64(full_prompt)
-        if b64:
-            char.image_base64 = b64
-            
-    # --- Generate Cover Image ---
+        full_prompt = HERO_PORTRAIT_PROMPT.format(
+            race=char.race,
+            class_name=char.class_name,
+            description=char.physical_description if char.physical_description else 'A brave adventurer.',
+            weapons=", ".join(w.name for w in char.weapons) if char.weapons else "none",
+            inventory=", ".join(char.inventory) if char.inventory else "none",
+            terrain=terrain,
+        )
+        portrait_jobs.append((char, "image_base64", full_prompt))
+
+    # --- Cover Image ---
     if state.campaign_plan and state.campaign_plan.key_locations:
-        cover_prompt = f"""A breathtaking, masterpiece digital landscape painting of {state.campaign_plan.key_locations[0]}. Terrain: {state.terrain if state.terrain else 'fantasy world'}. 
-        Aesthetic: High-fidelity fantasy concept art, Unreal Engine 5 render, global illumination, ray tracing, incredibly detailed, best quality, cinematic volumetric lighting, 8k resolution, photorealistic textures, vivid colors, painted by Greg Rutkowski and Magali Villeneuve. 
-        Critical Rule: NO TEXT, NO WATERMARKS, NO UI ELEMENTS, NO BORDERS."""
-        b64 = await generate_image_base64(cover_prompt)
-        if b64:
-            state.campaign_plan.cover_image_base64 = b64
-            
-    # --- Generate Group Image logically referencing the Hero Portraits ---
-    if state.party_details and state.party_details.characters:
-        heroes_b64 = [c.image_base64 for c in state.party_details.characters if c.image_base64]
-        if heroes_b64:
-            heroes_desc = "\n".join([f"- {c.name} ({c.race} {c.class_name}): {c.physical_description}" for c in state.party_details.characters])
-            group_prompt = f"""A breathtaking, masterpiece digital painting of a diverse adventuring party standing together heroically. 
-            The party consists of EXACTLY {len(state.party_details.characters)} characters:
-            {heroes_desc}
-            Details: Render all {len(state.party_details.characters)} characters standing next to each other, accurately reflecting their different heights, sizes, and builds in a cinematic group shot. They are in a {state.terrain if state.terrain else 'fantasy world'} environment. DO NOT render them as a grid; composite them into a single, cohesive cinematic shot looking at the camera. Use the provided individual portraits as direct visual reference for their faces, armor, and aesthetic.
-            Aesthetic: High-fidelity fantasy concept art, Unreal Engine 5 render, global illumination, ray tracing, incredibly detailed, best quality, cinematic volumetric lighting, 8k resolution, photorealistic textures, vivid colors. 
-            Critical Rule: NO TEXT, NO WATERMARKS, NO BORDERS. YOU MUST INCLUDE EXACTLY {len(state.party_details.characters)} DISTINCT PEOPLE."""
-            
-            b64 = await generate_image_base64_multimodal(group_prompt, heroes_b64)
-            if b64:
-                if state.campaign_plan:
-                    state.campaign_plan.group_image_base64 = b64
-            else:
-                # Fallback to the original math logic if the API rejects the multimodal format
-                print("Multimodal stitching failed. Falling back to simple prompt generation without reference images.")
-                b64 = await generate_image_base64(group_prompt)
-                if b64:
-                    if state.campaign_plan:
-                        state.campaign_plan.group_image_base64 = b64
-
-    # --- Generate Macguffin Image ---
+        cover_prompt = COVER_PROMPT.format(location=state.campaign_plan.key_locations[0], terrain=terrain)
+        scene_jobs.append((state.campaign_plan, "cover_image_base64", cover_prompt))
+
+    # --- Macguffin Image ---
     if state.campaign_plan and state.campaign_plan.loot_concept:
-        macguffin_prompt = f"""A breathtaking, masterpiece digital painting of a legendary D&D artifact or treasure: {state.campaign_plan.loot_concept}. 
-        Aesthetic: High-fidelity fantasy concept art, Unreal Engine 5 render, glowing magical aura, intricate details, best quality, dramatic shadows, cinematic lighting, 8k resolution, photorealistic textures. 
-        Critical Rule: NO TEXT, NO WATERMARKS, NO UI ELEMENTS, NO BORDERS."""
-        b64 = await generate_image_base64(macguffin_prompt)
-        if b64:
-            state.campaign_plan.macguffin_image_base64 = b64
+        macguffin_prompt = MACGUFFIN_PROMPT.format(loot=state.campaign_plan.loot_concept)
+        scene_jobs.append((state.campaign_plan, "macguffin_image_base64", macguffin_prompt))
+
+    async def run_job(target, field: str, prompt: str):
+        image = await generate_image_bytes(prompt)
+        if image:
+            setattr(target, field, image)
+
+    async def run_scene_job(target, field: str, prompt: str):
+        # The cover and macguffin only depend on the location/terrain/loot, which edits rarely touch.
+        # Runs without a thread_id have no campaign to scope the cache to, so they always generate.
+        key = (thread_id, prompt)
+        image = SCENE_IMAGE_CACHE.get(key) if thread_id else None
+        if image is None:
+            image = await generate_image_bytes(prompt)
+            if image and thread_id:
+                SCENE_IMAGE_CACHE[key] = image
+                while len(SCENE_IMAGE_CACHE) > SCENE_IMAGE_CACHE_SIZE:
+                    SCENE_IMAGE_CACHE.popitem(last=False)
+        else:
+            SCENE_IMAGE_CACHE.move_to_end(key)
+        if image:
+            setattr(target, field, image)
+
+    async def run_portraits_then_group():
+        await asyncio.gather(*(run_job(*job) for job in portrait_jobs))
+
+        # --- Generate Group Image logically referencing the Hero Portraits ---
+        # A hero whose new portrait failed keeps (and is referenced by) the one stored from an earlier run
+        hero_images = [img for c in state.party_details.characters if (img := image_bytes(c.image_base64))]
+        if not hero_images:
+            return
+        heroes_desc = "\n".join([f"- {c.name} ({c.race} {c.class_name}): {c.physical_description}" for c in state.party_details.characters])
+        group_prompt = GROUP_PORTRAIT_PROMPT.format(count=len(state.party_details.characters), heroes=heroes_desc, terrain=terrain)
+
+        # Optionally start the text-only fallback alongside the multimodal call, so a rejected multimodal
+        # request doesn't add a second full round-trip (at the cost of an extra image call when it succeeds)
+        fallback = asyncio.create_task(generate_image_bytes(group_prompt)) if SPECULATIVE_GROUP_IMAGE else None
+        use_fallback = False
+        try:
+            group_image = await generate_image_bytes_multimodal(group_prompt, hero_images)
+            use_fallback = not group_image
+        finally:
+            # Cancel the speculative call unless it is awaited below, including when this node is cancelled mid-call
+            if fallback and not use_fallback:
+                fallback.cancel()
+        if use_fallback:
+            # Fallback to the original math logic if the API rejects the multimodal format
+            print("Multimodal stitching failed. Falling back to simple prompt generation without reference images.")
+            group_image = await (fallback or generate_image_bytes(group_prompt))
+        if group_image and state.campaign_plan:
+            state.campaign_plan.group_image_base64 = group_image
+
+    await asyncio.gather(run_portraits_then_group(), *(run_scene_job(*job) for job in scene_jobs))
 
     return {
         "party_details": state.party_details,
         "campaign_plan": state.campaign_plan
     }
 
-async def narrative_writer_node(state: CampaignState):
+# The prose only needs who the characters are, not their combat sheets or the images,
+# so those fields are left out of the writer's (large, token-billed) context
+NARRATIVE_PLAN_EXCLUDE = {
+    "cover_image_base64": True,
+    "group_image_base64": True,
+    "macguffin_image_base64": True,
+    "villain_statblock": {"image_base64"},
+}
+NARRATIVE_PARTY_EXCLUDE = {
+    "characters": {"__all__": {"image_base64", "weapons", "spells", "skills", "ability_scores", "hp", "ac"}},
+}
+
+async def narrative_writer_node(state: CampaignState) -> Command[Literal["__end__"]]:
     """Node 3: Takes the structured facts and writes the final, high-quality Markdown prose."""
 
-    # Clear tools messages from previos node
-    state.messages.clear()
-
+    # Base64 images are swapped for a placeholder by the schema serializers to prevent Token Limit 400 errors.
+    # The JSON is left compact: indentation only adds prompt tokens.
+    prompt_context = {"for_prompt": True}
+    plan_context = "No plan available."
     if state.campaign_plan:
-        plan_dict = state.campaign_plan.model_dump(by_alias=True)
-        if plan_dict.get('villain_statblock') and 'image_base64' in plan_dict['villain_statblock']:
-            plan_dict['villain_statblock']['image_base64'] = "[GENERATED IMAGE STORED]"
-        if plan_dict.get('cover_image_base64'):
-            plan_dict['cover_image_base64'] = "[GENERATED IMAGE STORED]"
-        if plan_dict.get('group_image_base64'):
-            plan_dict['group_image_base64'] = "[GENERATED IMAGE STORED]"
-        if plan_dict.get('macguffin_image_base64'):
-            plan_dict['macguffin_image_base64'] = "[GENERATED IMAGE STORED]"
-        plan_context = json.dumps(plan_dict, indent=2)
-    else:
-        plan_context = "No plan available."
-    
+        plan_context = state.campaign_plan.model_dump_json(by_alias=True, exclude=NARRATIVE_PLAN_EXCLUDE, context=prompt_context)
+
     party_context = "No party details."
     if state.party_details:
-        party_dict = state.party_details.model_dump(by_alias=True)
-        # Strip out the massive base64 image strings before sending to LLM to prevent Token Limit 400 errors
-        for char in party_dict.get('characters', []):
-            if 'image_base64' in char:
-                char['image_base64'] = "[GENERATED IMAGE STORED]"
-        party_context = json.dumps(party_dict, indent=2)
+        party_context = state.party_details.model_dump_json(by_alias=True, exclude=NARRATIVE_PARTY_EXCLUDE, context=prompt_context)
 
     existing_narrative = "None"
     if state.title:
@@ -695,26 +969,56 @@ async def narrative_writer_node(state: CampaignState):
     3. If no Existing Prose is provided, write it from scratch using an engaging, cinematic style.
     """
     
-    # We use the higher temperature model here for better creative writing
-    structured_writer = writer_model.with_structured_output(CampaignContent)
-    content = await structured_writer.ainvoke(prompt)
+    # We use the higher temperature model here for better creative writing.
+    # Partial dicts are forwarded to the client as they grow so the prose shows up before the full completion.
+    draft = {}
+    try:
+        async for draft in narrative_model.astream(prompt):
+            await adispatch_custom_event("narrative_partial", draft)
+        content = CampaignContent.model_validate(draft)
+    except (ValidationError, OutputParserException) as e:
+        # An empty or truncated stream leaves no complete draft; one non-streaming call replaces it
+        print(f"Narrative stream ended without a complete draft ({type(e).__name__}), retrying without streaming")
+        content = CampaignContent.model_validate(await narrative_model.ainvoke(prompt))
     
-    return {
+    update = {
         "title": content.title,
         "description": content.description,
         "background": content.background,
-        "rewards": content.rewards
+        "rewards": content.rewards,
+        "chat_context": None
     }
+    # Clear tool messages from previous nodes through the reducer so they drop out of the checkpoint
+    if state.messages:
+        update["messages"] = [RemoveMessage(id=REMOVE_ALL_MESSAGES)]
+    # Final step of the pipeline: finish the run in the same write as the prose
+    return Command(update=update, goto=END)
+
+# YES/NO "does this request touch the story?" answers, keyed by the requirements text
+_STORY_CHANGE_CACHE: OrderedDict[str, bool] = OrderedDict()
+_STORY_CHANGE_CACHE_SIZE = 256
+
+# Only narrative-specific phrases skip the LLM classifier; generic words such as "description" or "background"
+# also describe characters ("change Thorin's physical description"), so those requests go to the LLM
+STORY_KEYWORDS = re.compile(r"\b(story|storyline|plot|narrative|lore|(?:campaign|adventure|quest) title)\b", re.IGNORECASE)
 
 async def determine_next_steps(state: CampaignState, current_node: str):
     """Determine the next steps in the campaign generation process."""
 
-    if current_node == "PlannerNode":
-        return "PartyCreationNode"
-    elif current_node == "PartyCreationNode":
-        if not state.title: # If no narrative has been written yet, go to character portraits
-            return "CharacterPortraitNode"
+    if current_node == "PartyCreationNode":
+        # Portraits and prose only read the plan + party, so they fan out and run in the same superstep
+        if not state.title: # If no narrative has been written yet, generate both
+            return ["CharacterPortraitNode", "NarrativeWriterNode"]
     
+        # Routing only depends on the requirements text, so repeat requests (e.g. a retried resume) skip the LLM
+        wants_story = _STORY_CHANGE_CACHE.get(state.requirements)
+        if wants_story is not None:
+            _STORY_CHANGE_CACHE.move_to_end(state.requirements)
+        elif STORY_KEYWORDS.search(state.requirements or ""):
+            wants_story = True
+        if wants_story is not None:
+            return ["CharacterPortraitNode", "NarrativeWriterNode"] if wants_story else END
+
         prompt = f"""Did the user request a change to the story, narrative, or TITLE, or just character stats?
 
         User Request: {state.requirements}
@@ -726,30 +1030,10 @@ async def determine_next_steps(state: CampaignState, current_node: str):
 
         response = await research_model.ainvoke(prompt)
         wants_story = "YES" in response.content.upper()
-        return "CharacterPortraitNode" if wants_story else END # If story changes, go to portraits, otherwise end.
-
-    elif current_node == "CharacterPortraitNode":
-        # After portraits, if a narrative exists, we might need to rewrite it.
-        # If state.title exists, it means a narrative was previously generated.
-        # If state.title does not exist, it means this is the first run, so we proceed to narrative.
-        if state.title:
-            # If a narrative exists, check if user requested changes that would require rewriting.
-            prompt = f"""Did the user request a change to the story, narrative, or TITLE?
-
-            User Request: {state.requirements}
-            
-            Respond with exactly ONE WORD:
-            - "YES" if they explicitly asked for story/plot/narrative/title changes
-            - "NO" if they only want character changes (which are already handled by portraits)
-            """
-            response = await research_model.ainvoke(prompt)
-            wants_story = "YES" in response.content.upper()
-            return "NarrativeWriterNode" if wants_story else END
-        else:
-            return "NarrativeWriterNode" # First run, always go to narrative after portraits
-
-    elif current_node == "NarrativeWriterNode":
-        return END
+        _STORY_CHANGE_CACHE[state.requirements] = wants_story
+        while len(_STORY_CHANGE_CACHE) > _STORY_CHANGE_CACHE_SIZE:
+            _STORY_CHANGE_CACHE.popitem(last=False)
+        return ["CharacterPortraitNode", "NarrativeWriterNode"] if wants_story else END # If story changes, redo portraits + prose, otherwise end.
 
     return END
 
@@ -757,11 +1041,20 @@ async def determine_next_steps(state: CampaignState, current_node: str):
 campaign_graph = StateGraph(CampaignState)
 
 # --- Chat Node (post-generation conversation) ---
-async def chat_node(state: CampaignState):
-    """Handles follow-up chat after campaign generation is complete.
-    Uses the full campaign context to respond as a knowledgeable DM."""
-    
-    # Build campaign context summary
+CHAT_SYSTEM_PROMPT = """You are an expert Dungeon Master who has just created an incredible D&D campaign. 
+You have deep knowledge of every detail of this campaign and can answer any question about it.
+You speak in a warm, knowledgeable, and slightly dramatic tone — like a seasoned DM at the table.
+Keep responses concise but flavorful (2-4 paragraphs max unless asked for detail).
+You can elaborate on lore, suggest encounter modifications, provide tactical advice, 
+expand on NPC motivations, create additional side quests, or help with any campaign-related questions.
+
+--- CAMPAIGN CONTEXT ---
+{campaign_context}
+--- END CONTEXT ---
+"""
+
+def build_chat_context(state: CampaignState) -> str:
+    """Summarizes the finished campaign for ChatNode's system prompt."""
     context_parts = []
     if state.campaign_plan:
         plan = state.campaign_plan
@@ -799,51 +1092,30 @@ async def chat_node(state: CampaignState):
     
     context_parts.append(f"Setting: {state.terrain or 'Fantasy world'}, Difficulty: {state.difficulty or 'Medium'}")
     
-    campaign_context = "\n".join(context_parts)
-    
-    # Build the chat history for context
-    chat_history = ""
-    if state.chat_messages:
-        for msg in state.chat_messages:
-            role = "DM" if msg.get("role") == "assistant" else "Player"
-            chat_history += f"\n{role}: {msg.get('content', '')}"
-    
-    system_prompt = f"""You are an expert Dungeon Master who has just created an incredible D&D campaign. 
-You have deep knowledge of every detail of this campaign and can answer any question about it.
-You speak in a warm, knowledgeable, and slightly dramatic tone — like a seasoned DM at the table.
-Keep responses concise but flavorful (2-4 paragraphs max unless asked for detail).
-You can elaborate on lore, suggest encounter modifications, provide tactical advice, 
-expand on NPC motivations, create additional side quests, or help with any campaign-related questions.
+    return "\n".join(context_parts)
 
---- CAMPAIGN CONTEXT ---
-{campaign_context}
---- END CONTEXT ---
-"""
+async def chat_node(state: CampaignState):
+    """Handles follow-up chat after campaign generation is complete.
+    Uses the full campaign context to respond as a knowledgeable DM."""
+    
+    # The campaign facts don't change between chat turns, so the summary is built once and kept in state
+    campaign_context = state.chat_context or build_chat_context(state)
     
-    # Get the latest user message (last item in chat_messages)
-    user_message = ""
-    if state.chat_messages:
-        user_message = state.chat_messages[-1].get("content", "")
+    system_prompt = CHAT_SYSTEM_PROMPT.format(campaign_context=campaign_context)
     
+    # Previous chat turns become the conversation history; the last entry is the current user message
+    *history, latest = state.chat_messages or [{"role": "user", "content": ""}]
     messages_for_llm = [
         SystemMessage(content=system_prompt),
+        *((HumanMessage if msg.get("role") == "user" else AIMessage)(content=msg["content"]) for msg in history),
+        HumanMessage(content=latest.get("content", "")),
     ]
     
-    # Add previous chat as conversation history
-    if len(state.chat_messages) > 1:
-        for msg in state.chat_messages[:-1]:
-            if msg.get("role") == "user":
-                messages_for_llm.append(HumanMessage(content=msg["content"]))
-            else:
-                messages_for_llm.append(AIMessage(content=msg["content"]))
-    
-    # Add current user message
-    messages_for_llm.append(HumanMessage(content=user_message))
-    
     response = await writer_model.ainvoke(messages_for_llm)
     
     return {
-        "chat_response": response.content
+        "chat_response": response.content,
+        "chat_context": campaign_context
     }
 
 campaign_graph.add_node("PlannerNode", planner_node)
@@ -856,70 +1128,62 @@ campaign_graph.add_node("ChatNode", chat_node)
 # Always start at the PlannerNode. If we are editing, PlannerNode handles the edit.
 campaign_graph.add_edge(START, "PlannerNode")
 
-# Async Route Wrappers for LangGraph
-async def route_planner(state: CampaignState):
-    return await determine_next_steps(state, "PlannerNode")
-
-async def route_party(state: CampaignState):
-    return await determine_next_steps(state, "PartyCreationNode")
+# Step 2: PlannerNode always hands off to PartyCreationNode, so it is wired as a plain edge
+campaign_graph.add_edge("PlannerNode", "PartyCreationNode")
 
-async def route_portraits(state: CampaignState):
-    return await determine_next_steps(state, "CharacterPortraitNode")
+# Step 3: PartyCreationNode and MCPToolNode route themselves by returning Command(update=..., goto=...)
 
-# Step 2: Dynamic Routing
-campaign_graph.add_conditional_edges(
-    "PlannerNode",
-    route_planner,
-    {
-        "PartyCreationNode": "PartyCreationNode",
-        "NarrativeWriterNode": "NarrativeWriterNode",
-        END: END
-    }
-)
-
-def route_tools_or_continue(state: CampaignState):
-    """Check if we should route to tools or continue to next step."""
-    messages = state.messages
-    if messages and isinstance(messages[-1], AIMessage) and messages[-1].tool_calls:
-        return "tools"
-    return "done"
-
-# Step 3: Dynamic Routing for PartyCreationNode
-campaign_graph.add_conditional_edges(
-    "PartyCreationNode",
-    route_tools_or_continue,
-    {
-        "tools": "MCPToolNode",
-        "done": "route_next"
-    }
-)
-
-# A fake passthrough node just to let LangGraph compile the route_next edge
-def dummy_route_node(state: CampaignState): return {"messages": []}
-campaign_graph.add_node("route_next", dummy_route_node)
-campaign_graph.add_conditional_edges(
-    "route_next", 
-    route_party,
-     {
-        "CharacterPortraitNode": "CharacterPortraitNode", 
-        "NarrativeWriterNode": "NarrativeWriterNode", 
-        END: END
-     })
-
-campaign_graph.add_conditional_edges(
-    "CharacterPortraitNode", 
-    route_portraits, 
-    {
-        "NarrativeWriterNode": "NarrativeWriterNode", 
-        END: END
-    })
-
-campaign_graph.add_edge("MCPToolNode", "PartyCreationNode")
-campaign_graph.add_edge("NarrativeWriterNode", END)
+# Portraits and narrative run concurrently and both finish the run (NarrativeWriterNode returns Command(goto=END))
+campaign_graph.add_edge("CharacterPortraitNode", END)
 campaign_graph.add_edge("ChatNode", END)
 
-memory = MemorySaver()
-app = campaign_graph.compile(checkpointer=memory, interrupt_after=["PlannerNode"])
+app = campaign_graph.compile(interrupt_after=["PlannerNode"])
+# Non-interactive runs never resume from the plan review, so they skip the interrupt and its pause checkpoint
+batch_app = campaign_graph.compile()
+
+# Checkpoints for local test runs spill to SQLite (WAL) instead of accumulating in process memory
+CLI_CHECKPOINT_DB = "./db/cli_state.db"
+
+async def run_with_sqlite_checkpoints(initial_state: CampaignState, config: dict) -> dict:
+    """Runs the graph with an on-disk SQLite checkpointer, echoing the narrative as it is written.
+    Pauses after PlannerNode unless config["configurable"]["interactive"] is False."""
+    interactive = config.get("configurable", {}).get("interactive", True)
+    async with AsyncSqliteSaver.from_conn_string(CLI_CHECKPOINT_DB) as memory:
+        await memory.setup() # creates the tables and switches the database to WAL
+        await memory.conn.execute("PRAGMA synchronous=NORMAL")
+        graph = (app if interactive else batch_app).copy(update={"checkpointer": memory})
+
+        printed = 0
+        async for event in graph.astream_events(initial_state, config, version="v2"):
+            if event["event"] == "on_custom_event" and event["name"] == "narrative_partial":
+                description = event["data"].get("description") or ""
+                print(description[printed:], end="", flush=True)
+                printed = len(description)
+        if printed:
+            print()
+
+        final_state = await graph.aget_state(config)
+        return final_state.values
+
+_main_runner: Optional[asyncio.Runner] = None
+
+def get_main_runner() -> asyncio.Runner:
+    """Returns the event loop runner shared by every main() call in this process.
+
+    The module-level model and image clients pool their HTTP connections on the loop they were
+    first used on, so reusing one loop keeps those connections (and TLS sessions) alive between runs.
+    """
+    global _main_runner
+    if _main_runner is None:
+        # uvloop's libuv-based loop has cheaper socket I/O than the stdlib loop; it is optional (no Windows support)
+        try:
+            import uvloop
+            loop_factory = uvloop.new_event_loop
+        except ImportError:
+            loop_factory = None
+        _main_runner = asyncio.Runner(loop_factory=loop_factory)
+        atexit.register(_main_runner.close)
+    return _main_runner
 
 def main():
     """Test the campaign generator"""
@@ -929,8 +1193,9 @@ def main():
         requirements="I want a quest involving a stolen dragon egg and a cult of ice monks.",
         party_details=PartyDetails(party_name="The Frozen Few", party_size=3)
     )
-    config = {"configurable": {"thread_id": "test_1"}}
-    final_state = asyncio.run(app.ainvoke(initial_state, config))
+    # A fresh thread per run: the checkpoint DB persists, and reusing a thread would resume the last campaign
+    config = {"configurable": {"thread_id": str(uuid.uuid4()), "interactive": False}}
+    final_state = get_main_runner().run(run_with_sqlite_checkpoints(initial_state, config))
     print(f"Generated Campaign: {final_state.get('title')}")
     print("Plan:", final_state.get('campaign_plan'))
 
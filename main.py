@@ -3,28 +3,155 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import Response
 import uvicorn
 import importlib
+import importlib.util
 import asyncio
 import logging
-from contextlib import suppress
+from contextlib import suppress, asynccontextmanager
+from collections import OrderedDict
 
 from pydantic import BaseModel
 from sse_starlette.sse import EventSourceResponse
-import json
+import orjson
 import uuid
 
 from langchain_core.messages import HumanMessage
-import sqlite3
+import aiosqlite
 import os    
 import datetime
-import uuid as uuid_module
+import struct
 
-from dnd import campaign_graph as app_graph, mcp_server_session, research_model, DynamicHitlActions, PartyDetails
+from dnd import campaign_graph as app_graph, mcp_server_session, mcp_pool, research_model, DynamicHitlActions, PartyDetails
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
-
-app = FastAPI()
+from langgraph.types import Command
 
 DB_PATH = "./db/state.db"
 
+def to_json(obj) -> str:
+    """Serialize an SSE/history payload with orjson, decoded to str for the SSE frame and history envelopes."""
+    return orjson.dumps(obj).decode()
+
+def sse(event: str, data: str) -> bytes:
+    """Preformatted SSE frame; EventSourceResponse writes bytes through untouched. data must be single-line (compact JSON is)."""
+    return f"event: {event}\r\ndata: {data}\r\n\r\n".encode()
+
+# Compiled (and validated) once at import; the app lifespan binds it to the shared checkpointer
+base_graph = app_graph.compile(interrupt_after=["PlannerNode"])
+
+def compile_with_checkpointer(memory):
+    """Return the campaign graph bound to the given checkpointer without recompiling it."""
+    return base_graph.copy(update={"checkpointer": memory})
+
+# Max PDF renders in flight at once per worker process; each holds a Chromium browser context, so this caps RAM
+PDF_MAX_CONCURRENCY = int(os.getenv("PDF_MAX_CONCURRENCY", str(2 * (os.cpu_count() or 1))))
+PDF_SLOTS = asyncio.Semaphore(PDF_MAX_CONCURRENCY)
+_pdf_browser_lock = asyncio.Lock()
+
+async def get_pdf_browser(async_playwright):
+    """Return the app-wide headless Chromium, launching it on the first export (or after it has died)."""
+    async with _pdf_browser_lock:
+        browser = app.state.browser
+        if browser is None or not browser.is_connected():
+            if app.state.playwright is None:
+                app.state.playwright = await async_playwright().start()
+            app.state.browser = await app.state.playwright.chromium.launch(
+                headless=True, args=["--disable-dev-shm-usage"]
+            )
+        return app.state.browser
+
+async def close_pdf_browser():
+    """Shut down the shared Chromium and its Playwright driver, if an export ever started them."""
+    with suppress(Exception):
+        if app.state.browser is not None:
+            await app.state.browser.close()
+    with suppress(Exception):
+        if app.state.playwright is not None:
+            await app.state.playwright.stop()
+    app.state.browser = app.state.playwright = None
+
+# Listing metadata for /threads: written as titles are produced so the list rarely has to decode checkpoints.
+# {title} picks whether a new title overwrites the stored one or only fills a gap.
+UPSERT_THREAD_META = """
+    INSERT INTO threads_meta (thread_id, is_archived, title, created_at) VALUES (?, 0, ?, ?)
+    ON CONFLICT(thread_id) DO UPDATE SET
+        title = {title},
+        created_at = COALESCE(threads_meta.created_at, excluded.created_at)
+"""
+
+async def ensure_app_tables(conn):
+    """Create threads_meta (adding the title/created_at columns to tables from older versions) and chat_log."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS threads_meta (
+            thread_id TEXT PRIMARY KEY,
+            is_archived INTEGER NOT NULL DEFAULT 0,
+            title TEXT,
+            created_at TEXT
+        )
+    """)
+    async with conn.execute("PRAGMA table_info(threads_meta)") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    for column in ("title", "created_at"):
+        if column not in columns:
+            # Several workers may migrate at once; losing the race just means the column is already there
+            with suppress(aiosqlite.OperationalError):
+                await conn.execute(f"ALTER TABLE threads_meta ADD COLUMN {column} TEXT")
+    # Post-generation chat lives outside the checkpoints so a chat turn never rewrites the whole campaign state
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_log (
+            thread_id TEXT PRIMARY KEY,
+            messages_json TEXT NOT NULL,
+            chat_context TEXT
+        )
+    """)
+    # An earlier version added a secondary index on checkpoints; the saver's primary key already covers
+    # the /threads lookup, so it only slowed every checkpoint write
+    await conn.execute("DROP INDEX IF EXISTS idx_checkpoints_tid_cid")
+    await conn.commit()
+
+async def record_thread_meta(thread_id: str, *, title: str | None = None, created_at: str | None = None, keep_title: bool = False):
+    """Upsert a thread's listing row; keep_title leaves an existing title alone (plan fallbacks never beat the narrative title)."""
+    title_sql = "COALESCE(threads_meta.title, excluded.title)" if keep_title else "COALESCE(excluded.title, threads_meta.title)"
+    await app.state.meta_db.execute(UPSERT_THREAD_META.format(title=title_sql), (thread_id, title, created_at))
+
+async def load_chat_log(thread_id: str):
+    """Return (chat_messages, chat_context) from chat_log, or None for threads that have not chatted since it existed."""
+    async with app.state.meta_db.execute(
+        "SELECT messages_json, chat_context FROM chat_log WHERE thread_id = ?", (thread_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return None
+    return orjson.loads(row["messages_json"]), row["chat_context"]
+
+# Applied to the shared threads_meta/chat_log connection (the checkpointer's setup already switches the file to WAL)
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-64000",
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens the checkpoint database once for the whole app; every endpoint shares app.state.compiled_graph and app.state.meta_db."""
+    async with AsyncSqliteSaver.from_conn_string(DB_PATH) as memory:
+        await memory.setup()
+        await ensure_app_tables(memory.conn)
+        app.state.checkpointer = memory
+        app.state.compiled_graph = compile_with_checkpointer(memory)
+        # One autocommit connection serves every threads_meta read/write; aiosqlite runs it on its own thread
+        async with aiosqlite.connect(DB_PATH, isolation_level=None) as meta_db:
+            for pragma in SQLITE_PRAGMAS:
+                await meta_db.execute(pragma)
+            meta_db.row_factory = aiosqlite.Row
+            app.state.meta_db = meta_db
+            # Chromium launches lazily on the first PDF export, so a missing browser never blocks startup
+            app.state.playwright = app.state.browser = None
+            yield
+    await close_pdf_browser()
+    await mcp_pool.close()
+
+app = FastAPI(lifespan=lifespan)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins = ["http://localhost:3000"],
@@ -52,118 +179,145 @@ class PdfExportRequest(BaseModel):
     html: str
     file_name: str | None = "campaign_export"
 
+# Gregorian (Oct 15, 1582) to Unix epoch offset, in 100-ns intervals
+_UUID_EPOCH_OFFSET = 0x01b21dd213814000
+_UTC = datetime.timezone.utc
+_UUID_TIME_FIELDS = struct.Struct(">IHH")
+
+def checkpoint_id_to_datetime(checkpoint_id: str) -> str:
+    """Extract real creation time from LangGraph checkpoint UUID (UUID v6 timestamp)."""
+    try:
+        # First 8 bytes hold the three time fields; the version nibble tops the third
+        first, second, third = _UUID_TIME_FIELDS.unpack(bytes.fromhex(checkpoint_id[:8] + checkpoint_id[9:13] + checkpoint_id[14:18]))
+        version = third >> 12
+        time_low = third & 0x0FFF
+        if version == 6:
+            # UUID v6 stores time as: time_high (32b) | time_mid (16b) | version+time_low (16b)
+            ts_100ns = (first << 28) | (second << 12) | time_low
+        elif version == 1:
+            # UUID v1 stores time as: time_low (32b) | time_mid (16b) | version+time_high (16b)
+            ts_100ns = (time_low << 48) | (second << 32) | first
+        else:
+            ts_100ns = None
+        if ts_100ns is not None:
+            ts = (ts_100ns - _UUID_EPOCH_OFFSET) / 1e7
+            return datetime.datetime.fromtimestamp(ts, tz=_UTC).replace(tzinfo=None).isoformat()
+    except Exception:
+        pass
+    # Fallback: use current time
+    return datetime.datetime.utcnow().isoformat()
+
 @app.get("/threads")
 async def get_threads():
     if not os.path.exists(DB_PATH):
         return []
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # LangGraph checkpoints table joined with our custom threads_meta table
-    # max(checkpoint_id) gives us the latest checkpoint for each thread, which is UUID v1-like
-    cursor.execute("""
-        SELECT c.thread_id, 
-               max(c.checkpoint_id) as latest_checkpoint_id,
-               min(c.checkpoint_id) as first_checkpoint_id,
-               tm.is_archived
-        FROM checkpoints c
-        LEFT JOIN threads_meta tm ON c.thread_id = tm.thread_id
-        GROUP BY c.thread_id
-        ORDER BY latest_checkpoint_id DESC
-        LIMIT 50
-    """)
-    rows = cursor.fetchall()
-    conn.close()
+    # LangGraph checkpoints table joined with our custom threads_meta table.
+    # ROW_NUMBER() picks each thread's latest checkpoint (checkpoint ids sort chronologically) off the
+    # saver's (thread_id, checkpoint_ns, checkpoint_id) primary key. Threads whose title/created_at are already in threads_meta skip
+    # the first-checkpoint lookup and never pull their checkpoint blob.
+    async with app.state.meta_db.execute("""
+        WITH latest AS (
+            SELECT thread_id, checkpoint_id,
+                   ROW_NUMBER() OVER (PARTITION BY thread_id ORDER BY checkpoint_id DESC) AS rn
+            FROM checkpoints
+            WHERE checkpoint_ns = ''
+        ), page AS (
+            SELECT thread_id, checkpoint_id AS latest_checkpoint_id
+            FROM latest
+            WHERE rn = 1
+            ORDER BY latest_checkpoint_id DESC
+            LIMIT 50
+        )
+        SELECT p.thread_id,
+               p.latest_checkpoint_id,
+               tm.is_archived,
+               tm.title,
+               tm.created_at,
+               CASE WHEN tm.created_at IS NULL THEN
+                   (SELECT MIN(checkpoint_id) FROM checkpoints WHERE thread_id = p.thread_id)
+               END AS first_checkpoint_id,
+               CASE WHEN tm.title IS NULL THEN c.type END AS checkpoint_type,
+               CASE WHEN tm.title IS NULL THEN c.checkpoint END AS checkpoint_blob
+        FROM page p
+        JOIN checkpoints c
+          ON c.thread_id = p.thread_id AND c.checkpoint_ns = '' AND c.checkpoint_id = p.latest_checkpoint_id
+        LEFT JOIN threads_meta tm ON tm.thread_id = p.thread_id
+        ORDER BY p.latest_checkpoint_id DESC
+    """) as cursor:
+        rows = await cursor.fetchall()
 
     threads = []
-    
-    def checkpoint_id_to_datetime(checkpoint_id: str) -> str:
-        """Extract real creation time from LangGraph checkpoint UUID (UUID v6 timestamp)."""
-        try:
-            u = uuid_module.UUID(checkpoint_id)
-            if u.version == 6:
-                # UUID v6 stores time as: time_high (32b) | time_mid (16b) | version+time_low (16b)
-                # Reconstruct 60-bit gregorian timestamp (100-ns intervals since Oct 15, 1582)
-                n = u.int
-                time_high = (n >> 96) & 0xFFFFFFFF
-                time_mid  = (n >> 80) & 0xFFFF
-                time_low  = (n >> 64) & 0x0FFF  # strip 4-bit version nibble
-                ts_100ns = (time_high << 28) | (time_mid << 12) | time_low
-                ts = (ts_100ns - 0x01b21dd213814000) / 1e7
-                return datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc).replace(tzinfo=None).isoformat()
-            elif u.version == 1:
-                ts = (u.time - 0x01b21dd213814000) / 1e7
-                return datetime.datetime.utcfromtimestamp(ts).isoformat()
-        except Exception:
-            pass
-        # Fallback: use current time
-        return datetime.datetime.utcnow().isoformat()
-    
-    async with AsyncSqliteSaver.from_conn_string(DB_PATH) as memory:
-        compiled_graph = app_graph.compile(checkpointer=memory, interrupt_after=["PlannerNode"])
-        for row in rows:
-            tid = row["thread_id"]
-            first_checkpoint_id = row["first_checkpoint_id"]
-            is_arch = bool(row["is_archived"]) if "is_archived" in row.keys() and row["is_archived"] else False
-            
-            # Extract real creation time from the very first checkpoint UUID
-            created_at = checkpoint_id_to_datetime(first_checkpoint_id)
-            
+    backfill = []
+
+    # Same serializer the checkpointer writes with, so blobs decode exactly as aget_state would
+    serde = app.state.checkpointer.serde
+    for row in rows:
+        tid = row["thread_id"]
+        # NULL when the thread has no threads_meta row yet
+        is_arch = bool(row["is_archived"])
+
+        # Otherwise extract real creation time from the very first checkpoint UUID
+        created_at = row["created_at"] or checkpoint_id_to_datetime(row["first_checkpoint_id"])
+
+        title = row["title"]
+        if not title:
             try:
-                state = await compiled_graph.aget_state({"configurable": {"thread_id": tid}})
-                
+                values = serde.loads_typed((row["checkpoint_type"], row["checkpoint_blob"])).get("channel_values", {})
+
                 # Try to extract the narrative title first
-                title = None
-                if state.values.get("title"):
-                    title = state.values["title"]
-                    
+                title = values.get("title")
+
                 # If no narrative title yet, fall back to Primary Antagonist from plan
-                if not title and state.values.get("campaign_plan"):
-                    antagonist = getattr(state.values["campaign_plan"], "primary_antagonist", None)
+                plan = values.get("campaign_plan")
+                if not title and plan:
+                    antagonist = plan.get("primary_antagonist") if isinstance(plan, dict) else getattr(plan, "primary_antagonist", None)
                     if antagonist:
                         title = f"Vs. {antagonist}"
-                        
-                # Absolute fallback
-                if not title:
-                    title = f"Campaign {tid[:6]}"
-                    
             except Exception:
-                title = f"Campaign {tid[:6]}"
-                
-            threads.append({
-                "id": tid,
-                "name": title, 
-                "createdAt": created_at,
-                "isArchived": is_arch
-            })
-            
+                title = None
+
+        # Threads created before threads_meta tracked titles get their row filled in once
+        if not row["created_at"] or (title and not row["title"]):
+            backfill.append((tid, title, created_at))
+
+        # Absolute fallback
+        if not title:
+            title = f"Campaign {tid[:6]}"
+
+        threads.append({
+            "id": tid,
+            "name": title, 
+            "createdAt": created_at,
+            "isArchived": is_arch
+        })
+
+    if backfill:
+        await app.state.meta_db.executemany(UPSERT_THREAD_META.format(title="COALESCE(threads_meta.title, excluded.title)"), backfill)
+
     return threads
 
 @app.patch("/threads/{thread_id}/archive")
-def toggle_archive_thread(thread_id: str):
+async def toggle_archive_thread(thread_id: str):
     """Archive or unarchive a campaign thread."""
     if not os.path.exists(DB_PATH):
         return {"error": "Database not found"}
-        
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Check if exists
-    cursor.execute("SELECT is_archived FROM threads_meta WHERE thread_id = ?", (thread_id,))
-    row = cursor.fetchone()
-    
-    if row is None:
-        cursor.execute("INSERT INTO threads_meta (thread_id, is_archived) VALUES (?, 1)", (thread_id,))
-        new_val = True
-    else:
-        new_val = not bool(row[0])
-        cursor.execute("UPDATE threads_meta SET is_archived = ? WHERE thread_id = ?", (1 if new_val else 0, thread_id))
-        
-    conn.commit()
-    conn.close()
-    return {"id": thread_id, "isArchived": new_val}
+
+    # Insert-or-flip in one statement, so concurrent toggles cannot interleave a read and a write
+    async with app.state.meta_db.execute("""
+        INSERT INTO threads_meta (thread_id, is_archived) VALUES (?, 1)
+        ON CONFLICT(thread_id) DO UPDATE SET is_archived = 1 - COALESCE(threads_meta.is_archived, 0)
+        RETURNING is_archived
+    """, (thread_id,)) as cursor:
+        row = await cursor.fetchone()
+
+    return {"id": thread_id, "isArchived": bool(row[0])}
+
+def wrap_output(key: str, obj) -> str:
+    """JSON text for {key: obj}; models go straight through model_dump_json (which base64-encodes the images) with no intermediate dict."""
+    if hasattr(obj, "model_dump_json"):
+        return '{"%s":%s}' % (key, obj.model_dump_json())
+    return to_json({key: obj}) if obj else "{}"
 
 @app.get("/threads/{thread_id}")
 async def get_thread_data(thread_id: str):
@@ -174,19 +328,14 @@ async def get_thread_data(thread_id: str):
     # LangGraph State DB retrieval
     config = {"configurable": {"thread_id": thread_id}}
     
-    async with AsyncSqliteSaver.from_conn_string(DB_PATH) as memory:
-        compiled_graph = app_graph.compile(checkpointer=memory, interrupt_after=["PlannerNode"])
-        state = await compiled_graph.aget_state(config)
-    
+    compiled_graph = app.state.compiled_graph
+    state = await compiled_graph.aget_state(config)
+
     if not state or not state.values:
         return {"messages": []}
         
     vals = state.values
     
-    # Map the retrieved pure state Pydantic models back to JSON standard format for React
-    plan_dict = vals.get("campaign_plan").model_dump() if hasattr(vals.get("campaign_plan"), "model_dump") else vals.get("campaign_plan")
-    party_dict = vals.get("party_details").model_dump() if hasattr(vals.get("party_details"), "model_dump") else vals.get("party_details")
-    
     narrative_dict = None
     if vals.get("title") and vals.get("background"):
         narrative_dict = {
@@ -196,15 +345,16 @@ async def get_thread_data(thread_id: str):
             "rewards": vals.get("rewards")
         }
         
-    # Include chat history
-    chat_messages = vals.get("chat_messages", [])
+    # Include chat history (threads that last chatted before chat_log existed still carry it in the checkpoint)
+    chat_log = await load_chat_log(thread_id)
+    chat_messages = chat_log[0] if chat_log else vals.get("chat_messages", [])
     
     # We pack the parsed state into structural elements the frontend understands natively as output history
     history_data = {
         "messages": [
-            {"output": json.dumps({"campaign_plan": plan_dict}) if plan_dict else "{}"},
-            {"output": json.dumps({"party_details": party_dict}) if party_dict else "{}"},
-            {"output": json.dumps(narrative_dict) if narrative_dict else "{}"}
+            {"output": wrap_output("campaign_plan", vals.get("campaign_plan"))},
+            {"output": wrap_output("party_details", vals.get("party_details"))},
+            {"output": to_json(narrative_dict) if narrative_dict else "{}"}
         ],
         "chat_messages": chat_messages
     }
@@ -221,46 +371,57 @@ async def chat_with_campaign(thread_id: str, req: ChatRequest):
     
     config = {"configurable": {"thread_id": thread_id}}
     
-    async with AsyncSqliteSaver.from_conn_string(DB_PATH) as memory:
-        compiled_graph = app_graph.compile(checkpointer=memory, interrupt_after=["PlannerNode"])
-        
-        # Get current state to read existing chat history
-        current_state = await compiled_graph.aget_state(config)
+    from dnd import chat_node, CampaignState
+
+    # Once a thread has chatted, its history and campaign summary are all chat_node needs
+    chat_log = await load_chat_log(thread_id)
+    if chat_log and chat_log[1]:
+        existing_chat, chat_context = chat_log
+        updated_chat = existing_chat + [{"role": "user", "content": req.message}]
+        state = CampaignState.model_construct(chat_messages=updated_chat, chat_context=chat_context)
+    else:
+        # Get current state to read the campaign (and any chat history from before chat_log)
+        current_state = await app.state.compiled_graph.aget_state(config)
         if not current_state or not current_state.values:
             return {"error": "Thread not found"}
-        
-        existing_chat = current_state.values.get("chat_messages", [])
-        updated_chat = existing_chat + [{"role": "user", "content": req.message}]
-        
-        # Directly invoke the chat_node function with reconstructed state
-        from dnd import chat_node, CampaignState
-        
+
         vals = current_state.values
-        state = CampaignState(
-            terrain=vals.get("terrain"),
-            difficulty=vals.get("difficulty"),
-            requirements=vals.get("requirements"),
-            campaign_plan=vals.get("campaign_plan"),
-            party_details=vals.get("party_details"),
-            title=vals.get("title"),
-            description=vals.get("description"),
-            background=vals.get("background"),
-            rewards=vals.get("rewards"),
-            chat_messages=updated_chat,
-        )
-        
-        result = await chat_node(state)
-        ai_response = result.get("chat_response", "I'm sorry, I couldn't formulate a response.")
-        
-        # Save the full chat history back to graph state for persistence
-        final_chat = updated_chat + [{"role": "assistant", "content": ai_response}]
-        await compiled_graph.aupdate_state(
-            config,
-            {"chat_messages": final_chat, "chat_response": ai_response},
-            as_node="NarrativeWriterNode"
-        )
-        
-        return {"response": ai_response, "chat_messages": final_chat}
+        existing_chat = chat_log[0] if chat_log else vals.get("chat_messages", [])
+        updated_chat = existing_chat + [{"role": "user", "content": req.message}]
+
+        # Directly invoke the chat_node function with the stored state. The values were validated when the
+        # checkpoint was written, so model_construct skips re-validating the nested plan and party models.
+        state = CampaignState.model_construct(**{**vals, "chat_messages": updated_chat})
+
+    result = await chat_node(state)
+    ai_response = result.get("chat_response", "I'm sorry, I couldn't formulate a response.")
+
+    # Save the full chat history to chat_log; the campaign checkpoint is left untouched
+    final_chat = updated_chat + [{"role": "assistant", "content": ai_response}]
+    await app.state.meta_db.execute(
+        "INSERT OR REPLACE INTO chat_log (thread_id, messages_json, chat_context) VALUES (?, ?, ?)",
+        (thread_id, to_json(final_chat), result.get("chat_context")),
+    )
+
+    return {"response": ai_response, "chat_messages": final_chat}
+
+# D&D-themed status line streamed when each graph node starts
+THEMED_STATUS = {
+    "PlannerNode": "🗺️ Mapping out the realm and villains...",
+    "PartyCreationNode": "⚔️ Rolling stats and crafting character sheets...",
+    "CharacterPortraitNode": "🎨 Painting portraits of the heroes...",
+    "NarrativeWriterNode": "📜 Inscribing the legendary deeds onto parchment...",
+    "MCPToolNode": "🔍 Consulting ancient tomes...",
+}
+# Only node-level events and the narrative prose stream reach the SSE loop; model, tool and inner-chain events
+# are dropped by the event stream before they are queued
+STREAMED_EVENT_NAMES = [*THEMED_STATUS, "narrative_partial"]
+# Status events never change, so their wire bytes are built once
+THEMED_STATUS_EVENTS = {name: sse("status", to_json({"status": status})) for name, status in THEMED_STATUS.items()}
+
+# LLM-written HITL suggestions keyed by (villain, conflict); only successful generations are cached
+HITL_CACHE: OrderedDict[tuple[str, str], dict] = OrderedDict()
+HITL_CACHE_SIZE = 1024
 
 @app.post("/generate")
 async def generate_quest(req: GenerateRequest):
@@ -268,141 +429,145 @@ async def generate_quest(req: GenerateRequest):
 
     async def event_generator():
         async with mcp_server_session():
-            async with AsyncSqliteSaver.from_conn_string(DB_PATH) as memory:
-                # Compile the graph on the fly with the async saver
-                compiled_graph = app_graph.compile(checkpointer=memory, interrupt_after=["PlannerNode"])
-                
-                try:
-                    # Provide a unique thread ID so the MemorySaver checkpointer doesn't fail
-                    thread_id = req.thread_id or str(uuid.uuid4())
-                    config = {"configurable": {"thread_id": thread_id}}
-                    
-                    # Immediately yield thread_id so client can save it for resume commands
-                    yield {"event": "thread_id", "data": json.dumps({"thread_id": thread_id})}
-                    
-                    if req.resume_action:
-                        # We are resuming from an interrupt!
-                        if req.resume_action == "approve":
-                            stream_iterator = compiled_graph.astream_events(None, config=config, version="v2")
-                        else:
-                            # User typed a Custom Edit or clicked a Dynamic Suggestion!
-                            # We update the state with the new instruction and wipe the plan so it reruns
-                            await compiled_graph.aupdate_state(
-                                config,
-                                {"requirements": req.resume_action, "campaign_plan": None},
-                                as_node="PlannerNode",
-                            )
-                            stream_iterator = compiled_graph.astream_events(None, config=config, version="v2")
+            compiled_graph = app.state.compiled_graph
+
+            try:
+                # Provide a unique thread ID so the MemorySaver checkpointer doesn't fail
+                thread_id = req.thread_id or str(uuid.uuid4())
+                config = {"configurable": {"thread_id": thread_id}}
+
+                # Immediately yield thread_id so client can save it for resume commands
+                yield sse("thread_id", to_json({"thread_id": thread_id}))
+
+                if not req.thread_id:
+                    await record_thread_meta(thread_id, created_at=datetime.datetime.now(_UTC).replace(tzinfo=None).isoformat())
+                else:
+                    # This run may rewrite the campaign, so the cached chat summary has to be rebuilt
+                    await app.state.meta_db.execute("UPDATE chat_log SET chat_context = NULL WHERE thread_id = ?", (thread_id,))
+
+                if req.resume_action:
+                    # We are resuming from an interrupt!
+                    if req.resume_action == "approve":
+                        stream_iterator = compiled_graph.astream_events(None, config=config, version="v2", include_names=STREAMED_EVENT_NAMES)
                     else:
-                        party_data = None
-                        if req.party_name or req.party_size:
-                            party_data = PartyDetails(
-                                party_name=req.party_name or "Not Provided",
-                                party_size=req.party_size or 4,
-                                characters=[]
-                            )
-                            
-                        initial_state = {
-                            "messages": [HumanMessage(content=req.prompt)],
-                            "difficulty": req.difficulty,
-                            "terrain": req.terrain,
-                            "requirements": req.requirements,
-                            "campaign_plan": None,
-                            "party_details": party_data,
-                            "title": None,
-                            "description": None,
-                            "background": None,
-                            "rewards": None,
-                        }
-                        stream_iterator = compiled_graph.astream_events(initial_state, config=config, version="v2")
+                        # User typed a Custom Edit or clicked a Dynamic Suggestion!
+                        # We update the state with the new instruction and wipe the plan so it reruns
+                        await compiled_graph.aupdate_state(
+                            config,
+                            {"requirements": req.resume_action, "campaign_plan": None},
+                            as_node="PlannerNode",
+                        )
+                        stream_iterator = compiled_graph.astream_events(None, config=config, version="v2", include_names=STREAMED_EVENT_NAMES)
+                else:
+                    party_data = None
+                    if req.party_name or req.party_size:
+                        party_data = PartyDetails(
+                            party_name=req.party_name or "Not Provided",
+                            party_size=req.party_size or 4,
+                            characters=[]
+                        )
 
-                    async for event in stream_iterator:
-                        kind = event["event"]
-                        name = event.get("name", "")
-    
-                        if kind == "on_chain_end" and "campaign_plan" in event["data"].get("output", {}):
-                            plan = event["data"]["output"]["campaign_plan"]
-                            yield {
-                                "event": "plan",
-                                "data": plan.model_dump_json() if hasattr(plan, 'model_dump_json') else json.dumps(plan)
-                            }
-                        if kind == "on_chain_end" and "party_details" in event["data"].get("output", {}):
-                            party = event["data"]["output"]["party_details"]
-                            yield {
-                                "event": "party",
-                                "data": party.model_dump_json() if hasattr(party, 'model_dump_json') else json.dumps(party)
-                            }
-                        elif kind == "on_chain_end" and "title" in event["data"].get("output", {}):
-                            title = event["data"]["output"].get("title")
-                            desc = event["data"]["output"].get("description")
-                            bg = event["data"]["output"].get("background")
-                            rewards = event["data"]["output"].get("rewards")
-                            yield {
-                                "event": "narrative",
-                                "data": json.dumps({"title": title, "description": desc, "background": bg, "rewards": rewards})
-                            }
-                        elif kind == "on_chain_start":
-                            # Customize status message to be D&D themed based on the node name!
-                            themed_status = None
-                            if name == "PlannerNode":
-                                themed_status = "🗺️ Mapping out the realm and villains..."
-                            elif name == "PartyCreationNode":
-                                themed_status = "⚔️ Rolling stats and crafting character sheets..."
-                            elif name == "CharacterPortraitNode":
-                                themed_status = "🎨 Painting portraits of the heroes..."
-                            elif name == "NarrativeWriterNode":
-                                themed_status = "📜 Inscribing the legendary deeds onto parchment..."
-                            elif name == "MCPToolNode":
-                                themed_status = "🔍 Consulting ancient tomes..."
-                            
-                            if themed_status:    
-                                yield {
-                                    "event": "status",
-                                    "data": json.dumps({"status": themed_status})
-                                }
-                        
-                    # CHECK IF GRAPH PAUSED
-                    state = await compiled_graph.aget_state(config)
-                    if state.next:
-                        # Graph is paused! We reached PlannerNode.
-                        # Yield HITL options!
-                        villain_name = state.values.get("campaign_plan").primary_antagonist if getattr(state.values.get("campaign_plan", None), "primary_antagonist", None) else "the villain"
-                        conflict = state.values.get("campaign_plan").core_conflict if getattr(state.values.get("campaign_plan", None), "core_conflict", None) else "the conflict"
-
-                        suggestion_prompt = f"Based on the plan:\nVillain: {villain_name}\nConflict: {conflict}\nSuggest 3 different directions the user might want to take this campaign by altering the plot, villain, or characters."
-
-                        try:
+                    initial_state = {
+                        "messages": [HumanMessage(content=req.prompt)],
+                        "difficulty": req.difficulty,
+                        "terrain": req.terrain,
+                        "requirements": req.requirements,
+                        "campaign_plan": None,
+                        "party_details": party_data,
+                        "title": None,
+                        "description": None,
+                        "background": None,
+                        "rewards": None,
+                    }
+                    stream_iterator = compiled_graph.astream_events(initial_state, config=config, version="v2", include_names=STREAMED_EVENT_NAMES)
+
+                async for event in stream_iterator:
+                    kind = event["event"]
+                    name = event.get("name", "")
+                    ev_data = event["data"]
+
+                    if kind == "on_chain_end":
+                        output = ev_data.get("output") or {}
+                        if isinstance(output, Command):
+                            # Nodes that route themselves return Command(update=..., goto=...)
+                            output = output.update or {}
+                        if not isinstance(output, dict):
+                            output = {}
+
+                        if "campaign_plan" in output:
+                            plan = output["campaign_plan"]
+                            yield sse("plan", plan.model_dump_json() if hasattr(plan, 'model_dump_json') else to_json(plan))
+                            antagonist = getattr(plan, "primary_antagonist", None)
+                            if antagonist:
+                                await record_thread_meta(thread_id, title=f"Vs. {antagonist}", keep_title=True)
+                        if "party_details" in output:
+                            party = output["party_details"]
+                            yield sse("party", party.model_dump_json(by_alias=True) if hasattr(party, 'model_dump_json') else to_json(party))
+                        elif "title" in output:
+                            title = output.get("title")
+                            desc = output.get("description")
+                            bg = output.get("background")
+                            rewards = output.get("rewards")
+                            yield sse("narrative", to_json({"title": title, "description": desc, "background": bg, "rewards": rewards}))
+                            if title:
+                                await record_thread_meta(thread_id, title=title)
+                    elif kind == "on_custom_event" and name == "narrative_partial":
+                        # Partial prose streamed from NarrativeWriterNode while it is still writing
+                        yield sse("narrative", to_json(ev_data))
+                    elif kind == "on_chain_start":
+                        # Customize status message to be D&D themed based on the node name!
+                        themed_status = THEMED_STATUS_EVENTS.get(name)
+                        if themed_status:
+                            yield themed_status
+
+                # CHECK IF GRAPH PAUSED
+                state = await compiled_graph.aget_state(config)
+                if state.next:
+                    # Graph is paused! We reached PlannerNode.
+                    # Yield HITL options!
+                    villain_name = state.values.get("campaign_plan").primary_antagonist if getattr(state.values.get("campaign_plan", None), "primary_antagonist", None) else "the villain"
+                    conflict = state.values.get("campaign_plan").core_conflict if getattr(state.values.get("campaign_plan", None), "core_conflict", None) else "the conflict"
+
+                    suggestion_prompt = f"Based on the plan:\nVillain: {villain_name}\nConflict: {conflict}\nSuggest 3 different directions the user might want to take this campaign by altering the plot, villain, or characters."
+
+                    # The prompt depends only on (villain, conflict), so a replayed plan reuses its suggestions
+                    hitl_key = (villain_name, conflict)
+                    try:
+                        hitl_data = HITL_CACHE.get(hitl_key)
+                        if hitl_data is None:
                             suggestions = await research_model.with_structured_output(DynamicHitlActions).ainvoke(suggestion_prompt)
                             hitl_data = suggestions.model_dump()
-                        except Exception:
-                            hitl_data = {
-                                "action_1_label": "💥 Make it harder", "action_1_payload": "Make the enemies stronger and the dungeon deadlier.",
-                                "action_2_label": "🎭 More roleplay", "action_2_payload": "Focus more on diplomacy and NPC interaction.",
-                                "action_3_label": "🐉 Add dragons", "action_3_payload": "Change the villain to an ancient dragon."
-                            }
-
-                        yield {"event": "hitl", "data": json.dumps(hitl_data)}
-                    else:
-                        yield {"event": "done", "data": "Generation Complete!"}
-                        
-                except asyncio.CancelledError:
-                    # Normal path when the client closes the SSE connection.
-                    logging.debug("SSE stream cancelled by client; ending event generator")
-                    return
-                except GeneratorExit:
-                    # Generator was closed by the server/runtime after disconnect.
-                    logging.debug("SSE event generator closed")
-                    return
-                except Exception as e:
-                    import traceback
-                    tb = traceback.format_exc()
-                    print(f"CRITICAL FASTAPI ERROR: {tb}")
-                    with suppress(Exception):
-                        yield {
-                            "event": "error",
-                            "data": json.dumps({"error": str(e) + "\n\nTraceback:\n" + tb})
+                            HITL_CACHE[hitl_key] = hitl_data
+                            while len(HITL_CACHE) > HITL_CACHE_SIZE:
+                                HITL_CACHE.popitem(last=False)
+                        else:
+                            HITL_CACHE.move_to_end(hitl_key)
+                    except Exception:
+                        hitl_data = {
+                            "action_1_label": "💥 Make it harder", "action_1_payload": "Make the enemies stronger and the dungeon deadlier.",
+                            "action_2_label": "🎭 More roleplay", "action_2_payload": "Focus more on diplomacy and NPC interaction.",
+                            "action_3_label": "🐉 Add dragons", "action_3_payload": "Change the villain to an ancient dragon."
                         }
-                    
+
+                    yield sse("hitl", to_json(hitl_data))
+                else:
+                    yield sse("done", "Generation Complete!")
+
+            except asyncio.CancelledError:
+                # Normal path when the client closes the SSE connection.
+                logging.debug("SSE stream cancelled by client; ending event generator")
+                return
+            except GeneratorExit:
+                # Generator was closed by the server/runtime after disconnect.
+                logging.debug("SSE event generator closed")
+                return
+            except Exception as e:
+                import traceback
+                tb = traceback.format_exc()
+                print(f"CRITICAL FASTAPI ERROR: {tb}")
+                with suppress(Exception):
+                    yield sse("error", to_json({"error": str(e) + "\n\nTraceback:\n" + tb}))
+
     return EventSourceResponse(event_generator())
 
 
@@ -428,33 +593,25 @@ async def export_pdf(req: PdfExportRequest):
         safe_name = "campaign_export"
 
     try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page()
-            await page.set_content(html, wait_until="networkidle")
-
-            await page.evaluate(
-                """
-                async () => {
-                  const images = Array.from(document.images || []);
-                  await Promise.all(images.map((img) => {
-                    if (img.complete) return Promise.resolve();
-                    return new Promise((resolve) => {
-                      img.addEventListener('load', resolve, { once: true });
-                      img.addEventListener('error', resolve, { once: true });
-                    });
-                  }));
-                }
-                """
-            )
+        browser = await get_pdf_browser(async_playwright)
+        async with PDF_SLOTS:
+            # A fresh context per export keeps cookies, storage and cache from leaking between users;
+            # only the browser process is shared
+            context = await browser.new_context()
+            try:
+                page = await context.new_page()
+                # set_content keeps the client's markup on about:blank, so it cannot reach file:// URLs on this host;
+                # networkidle comes after the load event, which already waits for every image
+                await page.set_content(html, wait_until="networkidle")
 
-            pdf_bytes = await page.pdf(
-                format="A4",
-                print_background=True,
-                prefer_css_page_size=True,
-                margin={"top": "12mm", "right": "12mm", "bottom": "12mm", "left": "12mm"},
-            )
-            await browser.close()
+                pdf_bytes = await page.pdf(
+                    format="A4",
+                    print_background=True,
+                    prefer_css_page_size=True,
+                    margin={"top": "12mm", "right": "12mm", "bottom": "12mm", "left": "12mm"},
+                )
+            finally:
+                await context.close()
 
         return Response(
             content=pdf_bytes,
@@ -465,5 +622,16 @@ async def export_pdf(req: PdfExportRequest):
         raise HTTPException(status_code=500, detail=f"PDF export failed: {exc}") from exc
 
 if __name__ == "__main__":
-    uvicorn.run(app, host = "0.0.0.0", port = 8001, reload = True)
+    # uvloop (no Windows builds) and httptools are optional C speedups; fall back to asyncio/h11 without them.
+    # No reload here: it needs an import string and runs the app in a child process under the default loop.
+    # One worker unless WEB_CONCURRENCY (the variable uvicorn/gunicorn read) asks for more. Every extra worker is
+    # its own process with its own lifespan, caches and IMAGE_SLOTS/PDF_SLOTS, which multiplies those limits.
+    uvicorn.run(
+        "main:app",
+        host = "0.0.0.0",
+        port = 8001,
+        workers = int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http = "httptools" if importlib.util.find_spec("httptools") else "h11",
+    )
     
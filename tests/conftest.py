@@ -0,0 +1,6 @@
+import os
+import sys
+
+# dnd.py builds its Gemini clients at import time; tests never call them, but the key must be present
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+import asyncio
+
+import dnd
+from dnd import CampaignState
+
+FULL_DRAFT = {
+    "title": "The Sunken Crown",
+    "description": "A drowned kingdom stirs.",
+    "background": "Long ago the sea swallowed Valdris.",
+    "rewards": "The crown of tides.",
+}
+
+
+class FakeNarrativeModel:
+    """Streams the given drafts, then answers the non-streaming fallback with a complete one."""
+
+    def __init__(self, drafts):
+        self.drafts = drafts
+        self.invoke_calls = 0
+
+    async def astream(self, prompt):
+        for draft in self.drafts:
+            yield draft
+
+    async def ainvoke(self, prompt):
+        self.invoke_calls += 1
+        return FULL_DRAFT
+
+
+def write(monkeypatch, drafts):
+    model = FakeNarrativeModel(drafts)
+    partials = []
+
+    async def record_partial(name, data):
+        partials.append(data)
+
+    monkeypatch.setattr(dnd, "narrative_model", model)
+    monkeypatch.setattr(dnd, "adispatch_custom_event", record_partial)
+    command = asyncio.run(dnd.narrative_writer_node(CampaignState()))
+    return command.update, model, partials
+
+
+def test_empty_stream_falls_back_to_one_invoke(monkeypatch):
+    update, model, partials = write(monkeypatch, [])
+    assert model.invoke_calls == 1
+    assert partials == []
+    assert update["title"] == FULL_DRAFT["title"]
+
+
+def test_truncated_draft_falls_back_to_one_invoke(monkeypatch):
+    update, model, partials = write(monkeypatch, [{"title": "The Sunk"}, {"title": "The Sunken Crown", "description": "A drow"}])
+    assert model.invoke_calls == 1
+    assert len(partials) == 2
+    assert update["rewards"] == FULL_DRAFT["rewards"]
+
+
+def test_complete_stream_needs_no_fallback(monkeypatch):
+    update, model, partials = write(monkeypatch, [{"title": "The Sunken Crown"}, FULL_DRAFT])
+    assert model.invoke_calls == 0
+    assert update["background"] == FULL_DRAFT["background"]
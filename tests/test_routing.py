@@ -0,0 +1,43 @@
+import asyncio
+
+import dnd
+from dnd import CampaignState, determine_next_steps
+from langgraph.graph import END
+
+
+class FakeClassifier:
+    """Stands in for research_model; answers the YES/NO story check and records the prompts it saw."""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.prompts = []
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(prompt)
+
+        class Reply:
+            content = self.answer
+
+        return Reply()
+
+
+def route(monkeypatch, requirements, answer="NO"):
+    classifier = FakeClassifier(answer)
+    monkeypatch.setattr(dnd, "research_model", classifier)
+    dnd._STORY_CHANGE_CACHE.clear()
+    state = CampaignState(title="The Sunken Crown", requirements=requirements)
+    return asyncio.run(determine_next_steps(state, "PartyCreationNode")), classifier
+
+
+def test_character_only_edits_are_left_to_the_classifier(monkeypatch):
+    for requirements in ("Change Thorin's physical description", "Give the rogue a noble background"):
+        next_steps, classifier = route(monkeypatch, requirements)
+        assert next_steps == END
+        assert len(classifier.prompts) == 1
+
+
+def test_narrative_phrases_skip_the_classifier(monkeypatch):
+    next_steps, classifier = route(monkeypatch, "Rewrite the plot so the mayor is the traitor")
+    assert next_steps == ["CharacterPortraitNode", "NarrativeWriterNode"]
+    assert classifier.prompts == []
+
@@ -0,0 +1,79 @@
+import asyncio
+
+import dnd
+from dnd import CampaignPlan, CampaignState, Character, PartyDetails
+
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 16
+
+
+def campaign_state():
+    hero = Character(
+        name="Thorin", race="Dwarf", class_name="Fighter", level=1, alignment="LG",
+        flavor_quote="Stone remembers.", physical_description="Braided beard", hp=12, ac=16, ability_scores={"STR": 16},
+    )
+    plan = CampaignPlan.model_construct(key_locations=["The Drowned Keep"], loot_concept="Crown of Tides", villain_statblock=None)
+    return CampaignState(party_details=PartyDetails(party_name="P", party_size=1, characters=[hero]), campaign_plan=plan, terrain="Coast")
+
+
+def run_portraits(monkeypatch, thread_id):
+    prompts = []
+
+    async def fake_generate(prompt):
+        prompts.append(prompt)
+        return JPEG
+
+    async def fake_multimodal(prompt, images):
+        return JPEG
+
+    monkeypatch.setattr(dnd, "generate_image_bytes", fake_generate)
+    monkeypatch.setattr(dnd, "generate_image_bytes_multimodal", fake_multimodal)
+    config = {"configurable": {"thread_id": thread_id}} if thread_id else None
+    asyncio.run(dnd.character_portrait_node(campaign_state(), config))
+    return [p for p in prompts if "Drowned Keep" in p or "Crown of Tides" in p]
+
+
+def test_scene_images_are_reused_within_a_thread_only(monkeypatch):
+    dnd.SCENE_IMAGE_CACHE.clear()
+    assert len(run_portraits(monkeypatch, "thread-a")) == 2
+    # Same campaign edited again: cover and macguffin come from the cache
+    assert run_portraits(monkeypatch, "thread-a") == []
+    # Another user's campaign with identical prompts still gets its own images
+    assert len(run_portraits(monkeypatch, "thread-b")) == 2
+
+
+def test_runs_without_a_thread_never_use_the_cache(monkeypatch):
+    dnd.SCENE_IMAGE_CACHE.clear()
+    assert len(run_portraits(monkeypatch, None)) == 2
+    assert len(run_portraits(monkeypatch, None)) == 2
+    assert not dnd.SCENE_IMAGE_CACHE
+
+
+def test_cancelled_node_cancels_the_speculative_group_image(monkeypatch):
+    dnd.SCENE_IMAGE_CACHE.clear()
+    fallback_cancelled = asyncio.Event()
+    multimodal_started = asyncio.Event()
+
+    async def fake_generate(prompt):
+        if "adventuring party" not in prompt:
+            return JPEG
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            fallback_cancelled.set()
+            raise
+
+    async def fake_multimodal(prompt, images):
+        multimodal_started.set()
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(dnd, "SPECULATIVE_GROUP_IMAGE", True)
+    monkeypatch.setattr(dnd, "generate_image_bytes", fake_generate)
+    monkeypatch.setattr(dnd, "generate_image_bytes_multimodal", fake_multimodal)
+
+    async def cancel_mid_multimodal():
+        node = asyncio.create_task(dnd.character_portrait_node(campaign_state()))
+        await multimodal_started.wait()
+        node.cancel()
+        await asyncio.wait_for(fallback_cancelled.wait(), timeout=1)
+
+    asyncio.run(cancel_mid_multimodal())
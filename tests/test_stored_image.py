@@ -0,0 +1,36 @@
+import base64
+
+from pydantic import TypeAdapter
+
+from dnd import Character, StoredImage, _decode_stored_image, image_bytes
+
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 16
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 16
+
+
+def test_base64_that_is_not_an_image_is_dropped():
+    # "none" is valid base64 (b'\x9e\x89\xde') but not an image
+    assert _decode_stored_image("none") is None
+    assert _decode_stored_image("not base64!") is None
+
+
+def test_base64_images_decode_to_raw_bytes():
+    assert _decode_stored_image(base64.b64encode(JPEG).decode()) == JPEG
+    assert _decode_stored_image(base64.b64encode(PNG).decode()) == PNG
+
+
+def test_stored_image_field_validation():
+    adapter = TypeAdapter(StoredImage)
+    assert adapter.validate_python("none") is None
+    assert adapter.validate_python(base64.b64encode(JPEG).decode()) == JPEG
+    assert adapter.validate_python(JPEG) == JPEG
+
+
+def test_image_bytes_decodes_legacy_checkpoint_strings():
+    # Checkpoints are restored via model_construct, which skips the BeforeValidator
+    legacy = Character.model_construct(image_base64=base64.b64encode(JPEG).decode())
+    assert isinstance(legacy.image_base64, str)
+    assert image_bytes(legacy.image_base64) == JPEG
+    assert image_bytes(JPEG) == JPEG
+    assert image_bytes("none") is None
+    assert image_bytes(None) is None